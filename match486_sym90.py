@@ -8,6 +8,10 @@ import matplotlib.pyplot as plt
 from xedrift.tpcClass import TPC_X1T
 import xedrift
 from xedrift.chargeMatching import *
+from xedrift.eventData import hdf_length
+from xedrift.chainStore import ChainStore, MetaRetention
+from xedrift.symmetryBasis import build_symmetry_basis
+from xedrift.fields import pack_fields, packed_up_to_date
 
 
 import sys
@@ -28,10 +32,13 @@ charges_n_z = 6 #number of vertical subdivisions for charge basis vectors
 
 nudge_single = True #only change one coefficient per iteration (gibbs sampling)
 nudge_scale = 0.2 #gaussian proposal distribution sigma
+delayed_acceptance = False #only drift proposals accepted by a linearized surrogate of the reverse-drifted grid
+drift_processes = 0 #number of worker processes sharing the basis fields for drifting, 0 to drift in this process
+meta_retention = MetaRetention(accepted_only=True, dtype=np.float32) #which reverse-drifted grids to save, e.g. every=10 or last=100 to bound disk usage
 
 data_name = 'kr83m/kr83m_sr1_{}'.format(sys.argv[1]) #folder with experimental data in data_dir, get dataset id from command line argument
 
-num_coefficients = charges_n_z * (charges_n_phi/2)/4 #number of coefficients for matching, /2 for uncharged fixed reflectors, /4 for 90 degree symmetry 
+num_coefficients = charges_n_z * charges_n_phi // 8 #number of coefficients for matching, /2 for uncharged fixed reflectors, /4 for 90 degree symmetry 
 
 state_0 = np.array([0.0] * num_coefficients) #initial state: zero charge
 
@@ -45,8 +52,8 @@ grid = np.array(list(itertools.product(xys,xys,dts)))
 
 # End parameters
 
-model_path = model_dir + model_name
-data_path = data_dir + data_name
+model_path = model_dir + '/' + model_name
+data_path = data_dir + '/' + data_name
 
 results_dir = '{}/matchresults/{}/{}/'.format(data_dir,data_name,model_name) #save results here
 
@@ -56,55 +63,66 @@ print("Results in: " + results_dir)
 
 # Prepare experimental data
 
-data = pd.read_hdf(data_path + '.hdf')
-data['drift_time_us'] = data.drift_time/1e3
-
-grid = preprocess_grid(grid, data) #Remove grid points that fall outside the data
-triangulation = triangulate_grid(grid)
-
-simp_counts = count_events(triangulation,data) #count events in observation space simplices
-tri_mask = mask_triangulation(triangulation,grid,simp_counts) #sanity checks on simplex aspect ratio, volume and event count
+#remove grid points outside the data, triangulate, count events in observation space simplices and apply sanity checks on simplex aspect ratio, volume and event count
+#results are cached and recalculated when the data, grid or masking parameters change
+grid, triangulation, simp_counts, tri_mask = cached_preprocessing(data_path + '.hdf', grid, data_dir + '/cache', vol_factor=2, count_sigma=3, max_side=100)
 simps_obs = triangulation.simplices.copy()[tri_mask]
 
-print("Events in triangulation: {:.2f}%".format(simp_counts.events.sum()/len(data)))
-print("Events in masked triangulation: {:.2f}%".format(simp_counts[tri_mask].events.sum()/len(data)))
+n_events = hdf_length(data_path + '.hdf')
+print("Events in triangulation: {:.2f}%".format(100*simp_counts.events.sum()/n_events))
+print("Events in masked triangulation: {:.2f}%".format(100*simp_counts[tri_mask].events.sum()/n_events))
 
 #superpos = makeSuperposition(model_path,charges_n_phi,charges_n_z) #code for matching without symmetry
 
 #load electric field data (basis vectors) with uncharged fixed reflectors, 90 degree symmetry
+#built from the charge fields if missing, equivalent to: python -m xedrift.symmetryBasis <model_path> --scheme n_sliding_only --n 6 --out <model_path>/symmetry_90_no_fixed
+if not all(os.path.exists(model_path + '/symmetry_90_no_fixed/field_{}.npz'.format(i)) for i in range(num_coefficients)):
+    build_symmetry_basis(model_path, model_path + '/symmetry_90_no_fixed', 'n_sliding_only', charges_n_phi, charges_n_z, charges_n_phi // 8)
+
 fields = [model_path + '/no_charge/electric_field.txt']
 for i in range(num_coefficients):
     fields += [model_path + '/symmetry_90_no_fixed/field_{}.npz'.format(i)]
     
 assert(len(state_0)==len(fields)-1)
+
+packed_path = model_path + '/symmetry_90_no_fixed/packed' #all basis vectors in a single file that can be memory-mapped
+if not packed_up_to_date(fields,packed_path): #repack when basis fields were rebuilt or reconverted
+    pack_fields(fields,packed_path)
     
-superpos = Superposition(fields) #load electric field data (basis vectors)
+superpos = Superposition(packed_path,incremental=nudge_single) #load electric field data (basis vectors), only add the changed basis vector for single coefficient steps
 
 
 from functools import partial
 
-log_l_f = partial(log_like_no_pool,tpc_x1t,superpos,grid,triangulation,tri_mask,simp_counts) #log-likelihood function for metropolis algorithm
+if drift_processes:
+    from xedrift.driftPool import DriftPool
+    drift_pool = DriftPool(superpos,tpc_x1t,grid,processes=drift_processes) #workers memory-map the packed basis fields once, only coefficients are sent per step
+    log_l_f = partial(log_like,tpc_x1t,superpos,grid,triangulation,tri_mask,simp_counts,drift_pool)
+else:
+    log_l_f = partial(log_like_no_pool,tpc_x1t,superpos,grid,triangulation,tri_mask,simp_counts) #log-likelihood function for metropolis algorithm
 
-match_data = init_match_data(results_dir, log_l_f, state_0) #set initial state or load saved state from previous run if found
+chain_store = ChainStore(results_dir + '/chain', retention=meta_retention) #each step is appended to binary files, previous results in matchresult.p are copied on first use
+chain_store.write_info(model_name=model_name, data_name=data_name, grid=grid, tri_data=(triangulation.simplices,tri_mask), simp_counts=simp_counts, symmetry='sym486_90')
+match_data = init_match_data(results_dir, log_l_f, state_0, chain_store) #set initial state or load saved state from previous run if found
 
 
-state = match_data.states[-1]
+state = np.array(match_data.states[-1])
 log_l = match_data.log_ls[-1]
 
+surrogate = LinearizedDrift(log_l_f,triangulation,tri_mask,simp_counts) if delayed_acceptance else None
+
 for i in range(n_iterations):
     start_time = time.time()
     
-    state, log_l, accepted, *meta = MHStep(state,log_l_f,log_l,scale=nudge_scale,nudgeSingle=nudge_single) #single step of metropolis algorithm
+    state, log_l, accepted, *meta = MHStep(state,log_l_f,log_l,scale=nudge_scale,nudgeSingle=nudge_single,surrogate=surrogate) #single step of metropolis algorithm
     if(accepted):
         print("Accepted! {}".format("single" if nudge_single else "all"))
+        superpos.commit() #keep the proposed superposition for incremental updates
+    else:
+        superpos.rollback()
         
     time_elapsed = (time.time() - start_time)
     
-    match_data.states.append(state)
-    match_data.log_ls.append(log_l)
-    match_data.accs.append(accepted)
-    match_data.metas.append(meta)
+    match_data.append(state, log_l, accepted, *meta) #save results
     print("---------------- {} | {:.2f} | {:.2f}%".format(i,time_elapsed,100*sum(match_data.accs[-50:])/50))
-    
-    if(accepted): #save results
-        pickle.dump({'match_data' : match_data, 'model_name' : model_name, 'data_name' : data_name, 'grid' : grid, 'tri_data' : (triangulation.simplices,tri_mask), 'simp_counts': simp_counts, 'symmetry' : 'sym486_90'} ,open(results_dir+'/matchresult.p','wb'))
+
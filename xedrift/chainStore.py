@@ -0,0 +1,260 @@
+import numpy as np
+import json
+import os
+import pickle
+
+#this file contains an append-only store for Metropolis chains, so long chains can be saved step by step without rewriting the whole history
+
+class MetaRetention:
+    """Policy for which metadata arrays (reverse-drifted grids) of a Metropolis chain are kept by a `ChainStore`, to bound disk usage.
+    The policy holds no state of its own, so it can be shared between chains
+
+        Args:
+            accepted_only: only keep metadata of accepted steps
+            every: only keep metadata of every n-th step
+            last: only keep the metadata of the last kept steps
+            dtype: type to store the metadata as, e.g. `numpy.float32` to halve the size
+    """
+    def __init__(self,accepted_only=False,every=None,last=None,dtype=None):
+        self.accepted_only = accepted_only
+        self.every = every
+        self.last = last
+        self.dtype = dtype
+
+    def keep(self,step,accepted):
+        """Whether the metadata of a step is kept (before limiting to the last ones)"""
+        return (accepted or not self.accepted_only) and (self.every is None or step % self.every == 0)
+
+    def convert(self,meta):
+        return meta if self.dtype is None or meta is None else np.asarray(meta,dtype=self.dtype)
+
+class ChainStore:
+    """Metropolis chain saved to a folder of flat binary files, one row appended per step
+
+    States, log-likelihoods and acceptance info are saved for every step, the metadata (reverse-drifted grid) returned by the
+    log-likelihood function only for steps where it was calculated, together with the step index. The arrays are read back as
+    memory maps, so resuming a chain does not load its history into memory.
+    Rows are written and flushed file by file, after a crash `__init__` truncates all files to the last complete step.
+    Has the attributes of `xedrift.chargeMatching.MatchData` used by the matching scripts
+
+    With a `MetaRetention` policy limiting metadata to the last kept steps, the metadata files are a fixed size ring buffer.
+    The shape, dtype and ring size of the metadata are fixed by the first metadata array saved
+
+        Args:
+            path: folder of the store, created if it doesn't exist
+            store_metas: if `False`, metadata is not saved
+            retention: a `MetaRetention` policy for the metadata
+    """
+    def __init__(self,path,store_metas=True,retention=None):
+        self.path = path
+        self.store_metas = store_metas
+        self.retention = retention or MetaRetention()
+        self.header = None
+        self._files = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        header_path = os.path.join(path,'header.json')
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                self.header = json.load(f)
+            self._recover()
+
+    def _file(self,name):
+        return os.path.join(self.path,name + '.bin')
+
+    def _row_specs(self):
+        """Dtype and row shape of each file"""
+        specs = {'states': ('float64',(self.header['n_coefficients'],)),
+                 'log_ls': ('float64',()),
+                 'accs': ('bool',())}
+        if self.header['meta_shape'] is not None:
+            specs['metas'] = (self.header['meta_dtype'],tuple(self.header['meta_shape']))
+            specs['meta_steps'] = ('int64',())
+        return specs
+
+    def _rows(self,name):
+        dtype, shape = self._row_specs()[name]
+        row_bytes = np.dtype(dtype).itemsize*int(np.prod(shape))
+        size = os.path.getsize(self._file(name)) if os.path.exists(self._file(name)) else 0
+        return size//row_bytes, row_bytes
+
+    def _recover(self):
+        """Truncate all files to the last step that was completely written"""
+        n_steps = min(self._rows(name)[0] for name in ('states','log_ls','accs'))
+        if 'metas' in self._row_specs():
+            n_metas = min(self._rows('metas')[0],self._rows('meta_steps')[0])
+            if self._slots():
+                steps = np.memmap(self._file('meta_steps'),dtype='int64',mode='r+')
+                steps[steps >= n_steps] = -1
+                steps.flush()
+                del steps
+            elif n_metas:
+                steps = self._read('meta_steps',n_metas)
+                n_metas = int(np.searchsorted(steps,n_steps)) #metadata of an incomplete step is dropped
+            self._truncate('metas',n_metas)
+            self._truncate('meta_steps',n_metas)
+
+        for name in ('states','log_ls','accs'):
+            self._truncate(name,n_steps)
+
+    def _truncate(self,name,n_rows):
+        row_bytes = self._rows(name)[1]
+        if os.path.exists(self._file(name)) and os.path.getsize(self._file(name)) != n_rows*row_bytes:
+            with open(self._file(name),'r+b') as f:
+                f.truncate(n_rows*row_bytes)
+
+    def _slots(self):
+        return self.header.get('meta_slots')
+
+    def _create(self,state):
+        self.header = {'n_coefficients': len(state),
+                       'meta_shape': None,
+                       'meta_dtype': None,
+                       'meta_slots': None}
+        self._write_header()
+
+    def _create_metas(self,meta):
+        """Set up the metadata files for the shape and type of the first metadata array, which may come after steps without metadata"""
+        meta = self.retention.convert(np.asarray(meta))
+        #leftovers of a crash before the header was updated
+        for name in ('metas','meta_steps'):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+        slots = self.retention.last
+        if slots:
+            with open(self._file('metas'),'wb') as f:
+                f.truncate(slots*meta.nbytes)
+            np.full(slots,-1,dtype='int64').tofile(self._file('meta_steps')) #-1 marks empty slots
+        self.header.update(meta_shape=list(meta.shape),meta_dtype=meta.dtype.str,meta_slots=slots)
+        self._write_header()
+
+    def _write_header(self):
+        header_path = os.path.join(self.path,'header.json')
+        with open(header_path + '.tmp','w') as f:
+            json.dump(self.header,f)
+        os.replace(header_path + '.tmp',header_path)
+
+    def _write_slot(self,step,meta):
+        """Overwrite the metadata of the oldest step in the ring buffer"""
+        steps = np.memmap(self._file('meta_steps'),dtype='int64',mode='r+')
+        slot = int(np.argmin(steps))
+        steps[slot] = -1 #the slot is invalid while it is written
+        steps.flush()
+
+        dtype, shape = self._row_specs()['metas']
+        metas = np.memmap(self._file('metas'),dtype=dtype,mode='r+',shape=(self._slots(),) + shape)
+        metas[slot] = meta
+        metas.flush()
+        del metas
+
+        steps[slot] = step
+        steps.flush()
+        del steps
+
+    def _read(self,name,n_rows=None):
+        dtype, shape = self._row_specs()[name]
+        if n_rows is None:
+            n_rows = self._rows(name)[0]
+        if n_rows == 0:
+            return np.empty((0,) + shape,dtype=dtype)
+        return np.memmap(self._file(name),dtype=dtype,mode='r',shape=(n_rows,) + shape)
+
+    def _write(self,name,values):
+        if name not in self._files:
+            self._files[name] = open(self._file(name),'ab')
+        f = self._files[name]
+        dtype, shape = self._row_specs()[name]
+        f.write(np.ascontiguousarray(values,dtype=dtype).tobytes())
+        f.flush()
+
+    def __len__(self):
+        return 0 if self.header is None else self._rows('accs')[0]
+
+    def append(self,state,log_l,accepted,meta=None):
+        """Save a step of the chain
+
+            Args:
+                state: the state vector
+                log_l: the log-likelihood
+                accepted: whether the step was accepted
+                meta: array returned by the log-likelihood function in addition to the log-likelihood (e.g. the reverse-drifted grid), or `None`
+        """
+        if self.header is None:
+            self._create(state)
+
+        step = len(self)
+        if meta is not None and self.store_metas and self.retention.keep(step,accepted):
+            if self.header['meta_shape'] is None:
+                self._create_metas(meta)
+            if self._slots():
+                self._write_slot(step,meta)
+            else:
+                self._write('metas',meta)
+                self._write('meta_steps',step)
+        #accs is written last, a step counts as complete once it is there
+        self._write('states',state)
+        self._write('log_ls',log_l)
+        self._write('accs',accepted)
+
+    def replace_last(self,state,log_l):
+        """Replace the state and log-likelihood of the last step, e.g. after recalculating the log-likelihood when resuming"""
+        n_steps = len(self)
+        for name, value in (('states',state),('log_ls',log_l)):
+            dtype, shape = self._row_specs()[name]
+            values = np.memmap(self._file(name),dtype=dtype,mode='r+',shape=(n_steps,) + shape)
+            values[-1] = value
+            values.flush()
+            del values
+
+    @property
+    def states(self):
+        return self._read('states',len(self))
+
+    @property
+    def log_ls(self):
+        return self._read('log_ls',len(self))
+
+    @property
+    def accs(self):
+        return self._read('accs',len(self))
+
+    def _meta_order(self):
+        """Slots of the ring buffer in the order of their steps"""
+        steps = np.array(self._read('meta_steps'))
+        order = np.argsort(steps)
+        return order[steps[order] >= 0]
+
+    @property
+    def meta_steps(self):
+        """Step index of each saved metadata array"""
+        if not self.header or 'metas' not in self._row_specs():
+            return np.empty(0,dtype='int64')
+        if self._slots():
+            return np.array(self._read('meta_steps'))[self._meta_order()]
+        return self._read('meta_steps')
+
+    @property
+    def metas(self):
+        """Saved metadata arrays, see `meta_steps` for the corresponding steps"""
+        if not self.header or 'metas' not in self._row_specs():
+            return None
+        if self._slots():
+            return self._read('metas')[self._meta_order()]
+        return self._read('metas')
+
+    def write_info(self,**info):
+        """Save information about the chain that doesn't change between steps (e.g. model name, grid, triangulation) to info.p"""
+        with open(os.path.join(self.path,'info.p'),'wb') as f:
+            pickle.dump(info,f)
+
+    def info(self):
+        """Load the information saved with `write_info`"""
+        with open(os.path.join(self.path,'info.p'),'rb') as f:
+            return pickle.load(f)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
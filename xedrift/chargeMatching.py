@@ -1,44 +1,30 @@
 import pickle
 import pandas as pd
 import time, os
+import hashlib
+from collections import namedtuple
 from functools import partial
 from xedrift.driftingNaive import Drifting2D
 from xedrift.driftingNaive3D import Drifting3D
-from xedrift.fields import Superposition
+from xedrift.driftingBatch import DriftingBatch2D, DriftingBatch3D
+from xedrift.driftingAdaptive import DriftingAdaptive
+from xedrift.fields import Field, RotatedField, Superposition
+from xedrift.eventData import read_hdf_chunks, add_derived_columns
+from xedrift.locator import LatticeLocator
+import xedrift.geometry as geometry
 import numpy as np
 
 def volumes2D(simps):
-    return np.array([vol2D(simp) for simp in simps])
-
-def rsqint(v0,v1):
-    r0,z0 = v0
-    r1,z1 = v1
-
-    dr = r1-r0
-    dz = z1-z0
-    if dr == 0:
-        return dz*r0**2
-
-    return dz/dr * (r1**3-r0**3)/3
+    """Calculate the volumes of the solids generated by rotating a list of triangles in r-z space around z"""
+    return geometry.rz_volumes(np.asarray(simps,dtype=float))
 
 def vol2D(verts):
     """Calculate volume of solid generated by rotating triangle around z"""
-    vs = sorted(verts,key=lambda v:v[1]) #sort by z coordinate
-    vb,vm,vt = vs #bottom, middle, top
+    return volumes2D([verts])[0]
 
-    return np.abs(rsqint(vb,vm) + rsqint(vm,vt) - rsqint(vb,vt))
-
-from scipy.spatial import ConvexHull
 def volumes3D(simps):
-    """Calculate the volumes for a list of simplices"""
-    def volHelper(simp):
-        try:
-            return ConvexHull(simp).volume
-        except Exception:
-            #print(simp)
-            return -1
-
-    return np.array([volHelper(simp) for simp in simps])
+    """Calculate the volumes for a list of simplices, -1 for degenerate simplices"""
+    return geometry.tetra_volumes(np.asarray(simps,dtype=float))
 
 def counts_volumes(grid_real,tri,tri_mask,simpdf):
     """Calculate the expected number of events in each simplex (assuming uniform distribution) in real space used in the likelihood calculation
@@ -64,6 +50,10 @@ def counts_volumes(grid_real,tri,tri_mask,simpdf):
         inv_volumes = np.where(np.logical_not(volumes_valid[tri_mask]))[0]
         print("{} invalid volumes! {}".format(len(inv_volumes),inv_volumes))
 
+    inverted = geometry.inverted(simps_real,tri.points[tri.simplices])[tri_mask]
+    if(np.any(inverted)):
+        print("{} inverted simplices! {}".format(np.sum(inverted),np.where(inverted)[0]))
+
 
     vol_tpc = np.sum(volumes[tri_mask]) #correct?
     #print("TPC volume %: {0:.3f}".format(vol_tpc/(tpc_x1t.r_max**2 * -(tpc_x1t.z_min))))
@@ -78,6 +68,36 @@ def deviations(simpdf,count_expected,count_std,tri_mask):
 def driftHelp(drifter,x0):
     return drifter.driftReverse(x0)
 
+def make_drifter(field,tpc,drift_method='batch'):
+    """Create a drifter for reverse drifting in `field`
+    
+    Args:
+        field: the drift field, 2D (r-z) or 3D
+        tpc: an object specifying the bounds of the TPC and the drift velocity
+        drift_method: 'scalar' to drift one grid point at a time, 'batch' to drift all grid points together,
+            'adaptive' to drift all grid points together with an adaptive Runge-Kutta method
+    """
+    if(drift_method == 'scalar'):
+        return Drifting2D(field,tpc) if field.dim_space==2 else Drifting3D(field,tpc)
+    elif(drift_method == 'batch'):
+        return DriftingBatch2D(field,tpc) if field.dim_space==2 else DriftingBatch3D(field,tpc)
+    elif(drift_method == 'adaptive'):
+        return DriftingAdaptive(field,tpc)
+    else:
+        raise ValueError("Unknown drift method {}".format(drift_method))
+
+def drift_grid(drifter,grid_obs,drift_method='batch',pool=None,chunksize=60):
+    """Reverse-drift all observation space grid points, optionally in parallel using `pool`"""
+    drift_f = partial(driftHelp,drifter)
+    if(drift_method == 'scalar'):
+        mapped = pool.map(drift_f,grid_obs,chunksize=chunksize) if pool else map(drift_f,grid_obs)
+        return np.array(list(mapped))
+
+    if(pool):
+        chunks = np.array_split(grid_obs,int(np.ceil(len(grid_obs)/chunksize)))
+        return np.concatenate(pool.map(drift_f,chunks))
+    return drifter.driftReverse(grid_obs)
+
 def log_like_grid(grid_real,triangulation,tri_mask,simpdf):
     """Calculate log-likelihood for each real space subvolume (simplex) obtained by reverse drifting
     Simplices with invalid results, e.g. due to no events expected, are set to twice the worst valid result
@@ -96,26 +116,28 @@ def log_like_grid(grid_real,triangulation,tri_mask,simpdf):
     log_l = -0.5*devs**2 - np.log(count_std[tri_mask])
     return log_l.fillna(2*log_l.min()), devs
 
-def log_like(tpc,superpos,grid_obs,triangulation,tri_mask,simpdf,pool,coeffs,field_override=None):
-    """As `log_like_no_pool` but using a pool to do drifting in parallel"""
-    if(field_override):
-        field = field_override
-    else:
-        field = superpos.getWithBase(coeffs)
-
-    if(field.dim_space==2):
-        drifter = Drifting2D(field,tpc)
+def log_like(tpc,superpos,grid_obs,triangulation,tri_mask,simpdf,pool,coeffs,field_override=None,drift_method='batch'):
+    """As `log_like_no_pool` but using a pool to do drifting in parallel
+    
+    `pool` can be a `multiprocessing.Pool`, which gets sent the whole field for every step,
+    or a `xedrift.driftPool.DriftPool`, which only gets sent the coefficients (`grid_obs`, `drift_method` and `field_override` are then ignored)
+    """
+    if(hasattr(pool,'drift')):
+        grid_r = pool.drift(np.concatenate(([1],coeffs)))
     else:
-        drifter = Drifting3D(field,tpc)
+        if(field_override):
+            field = field_override
+        else:
+            field = superpos.getWithBase(coeffs)
 
-    drift_f = partial(driftHelp,drifter)
-    grid_r = np.array(pool.map(drift_f, grid_obs,chunksize=60))
+        drifter = make_drifter(field,tpc,drift_method)
+        grid_r = drift_grid(drifter,grid_obs,drift_method,pool)
 
     log_l, devs = log_like_grid(grid_r,triangulation,tri_mask,simpdf)
     
     return np.sum(log_l), grid_r
 
-def log_like_no_pool(tpc,superpos,grid_obs,triangulation,tri_mask,simpdf,coeffs,field_override=None):
+def log_like_no_pool(tpc,superpos,grid_obs,triangulation,tri_mask,simpdf,coeffs,field_override=None,drift_method='batch'):
     """Calculate the log-likelihood for a given charge distribution by drifting charges backwards along the fieldlines
     
     Args:
@@ -126,6 +148,8 @@ def log_like_no_pool(tpc,superpos,grid_obs,triangulation,tri_mask,simpdf,coeffs,
         tri_mask: a list of booleans corresponding to each simplex in `triangulation`. Simplices corresponding to `False` entries are excluded from the likelihood calculation
         simpdf: a `pandas.DataFrame` containing the number of events observed in each simplex
         coeffs: coefficients corresponding to the charge distribution, passed to `superpos.getWithBase`
+        field_override: use this field instead of calculating it from `superpos`
+        drift_method: passed to `make_drifter`, 'batch' or 'adaptive' drift all grid points together
         
     Returns:
         the log-likelihood, the reverse-drifted grid points in real space corresponding to `grid_obs`
@@ -138,19 +162,71 @@ def log_like_no_pool(tpc,superpos,grid_obs,triangulation,tri_mask,simpdf,coeffs,
     else:
         field = superpos.getWithBase(coeffs)
 
-    if(field.dim_space==2):
-        drifter = Drifting2D(field,tpc)
-    else:
-        drifter = Drifting3D(field,tpc)
-
-    drift_f = partial(driftHelp,drifter)
-    grid_r = np.array(list(map(drift_f, grid_obs)))
+    drifter = make_drifter(field,tpc,drift_method)
+    grid_r = drift_grid(drifter,grid_obs,drift_method)
 
     log_l, devs = log_like_grid(grid_r,triangulation,tri_mask,simpdf)
 
     return np.sum(log_l), grid_r
 
-def MHStep(state,log_l_f,log_l_prev,scale=0.2,nudgeSingle=True):
+class LinearizedDrift:
+    """Linear model of the reverse-drifted grid as a function of the state vector, used as a cheap surrogate likelihood
+    
+    The Jacobian of the reverse-drifted grid with respect to each coefficient is calculated with finite differences at a reference state
+    and recalculated automatically when the chain moves too far away from it
+
+    Args:
+        log_l_f: a log-likelihood function like `log_like_no_pool` that accepts a state vector and returns the log-likelihood and the reverse-drifted grid
+        triangulation, tri_mask, simpdf: as for `log_like_grid`
+        eps: finite difference step for the Jacobian, coefficients are decreased by eps since positive coefficients are invalid
+        max_distance: recalculate the Jacobian when the euclidean distance between state and reference state is larger than this
+    """
+    def __init__(self,log_l_f,triangulation,tri_mask,simpdf,eps=0.05,max_distance=0.5):
+        self.log_l_f = log_l_f
+        self.grid_args = (triangulation,tri_mask,simpdf)
+        self.eps = eps
+        self.max_distance = max_distance
+        self.reference = None
+
+    def update(self,state):
+        """Calculate the Jacobian at a new reference state, needs one full drift per coefficient"""
+        start_time = time.time()
+        self.reference = np.array(state,dtype=float)
+        log_l, self.grid_ref = self.log_l_f(self.reference)
+
+        self.jacobian = np.empty((len(state),) + self.grid_ref.shape)
+        for idx in range(len(state)):
+            perturbed = self.reference.copy()
+            perturbed[idx] -= self.eps
+            log_l, grid_r = self.log_l_f(perturbed)
+            self.jacobian[idx] = (self.grid_ref - grid_r)/self.eps
+
+        self._cache = {}
+        print("Jacobian calculation took {:.2f} s".format(time.time() - start_time))
+
+    def recenter(self,state):
+        """Recalculate the Jacobian if state is too far away from the reference state"""
+        if self.reference is None or np.linalg.norm(state - self.reference) > self.max_distance:
+            self.update(state)
+
+    def predict(self,state):
+        """Predict the reverse-drifted grid for state"""
+        return self.grid_ref + np.tensordot(state - self.reference,self.jacobian,axes=1)
+
+    def log_like(self,state):
+        """Surrogate log-likelihood calculated from the predicted reverse-drifted grid"""
+        if np.any(state > 0):
+            return -np.inf
+
+        key = state.tobytes() #the current state is evaluated again in every step
+        if key not in self._cache:
+            if len(self._cache) > 8:
+                self._cache = {}
+            log_l, devs = log_like_grid(self.predict(state),*self.grid_args)
+            self._cache[key] = np.sum(log_l)
+        return self._cache[key]
+
+def MHStep(state,log_l_f,log_l_prev,scale=0.2,nudgeSingle=True,surrogate=None):
     """Calculate a single step of the Metropolis algorithm
     
     Args:
@@ -159,12 +235,14 @@ def MHStep(state,log_l_f,log_l_prev,scale=0.2,nudgeSingle=True):
         log_l_prev: the log-likelihood for the current state
         scale: the scale of the normal distribution used to modify the state vector
         nudgeSingle: if `True`, only one coefficient of the state vector is modified for each step (Gibbs-sampling)
+        surrogate: a `LinearizedDrift` object for a delayed-acceptance step: proposals are first accepted or rejected based on the
+            surrogate likelihood, `log_l_f` is only called for proposals accepted by the surrogate and then corrected for the surrogate
         
     Returns:
         the new state vector,
         the corresponding log-likelihood,
         a boolean indicating if the proposed state was accepted,
-        the remaining return values of `log_l_f`
+        the remaining return values of `log_l_f` (`None` if the proposal was rejected by the surrogate)
     """
     #make new guess
     newstate = state.copy()
@@ -177,9 +255,17 @@ def MHStep(state,log_l_f,log_l_prev,scale=0.2,nudgeSingle=True):
     newstate = np.clip(newstate,None,0)
 
     #print("New state: {}".format(np.array2string(newstate, formatter={'float_kind':'{0:.3f}'.format})))
+    log_s_ratio = 0
+    if(surrogate):
+        surrogate.recenter(state)
+        log_s_ratio = surrogate.log_like(newstate) - surrogate.log_like(state)
+        print("Surrogate L ratio: {:.3e}".format(np.exp(log_s_ratio)))
+        if not (np.random.uniform(0,1) < np.exp(log_s_ratio)):
+            return (state, log_l_prev, False, None)
+
     log_l, *meta = log_l_f(newstate)
     print("{:.3f}/{:.3f}".format(log_l,log_l_prev))
-    l_ratio = np.exp(log_l - log_l_prev)
+    l_ratio = np.exp(log_l - log_l_prev - log_s_ratio) #second stage of delayed acceptance corrects for the surrogate
     print("L ratio: {:.3e}".format(l_ratio))
     #accept newstate with probability l_ratio
     if(np.random.uniform(0,1) < l_ratio):
@@ -188,6 +274,7 @@ def MHStep(state,log_l_f,log_l_prev,scale=0.2,nudgeSingle=True):
         return (state, log_l_prev, False, *meta)
 
 pos_cols = ['x_observed_nn','y_observed_nn','drift_time_us']
+pos_cols_2D = ['r_observed_nn','drift_time_us'] #for matching azimuthally averaged data with 2D (r-z) fields
 
 def make_dir(directory):
     if not os.path.exists(directory):
@@ -197,91 +284,210 @@ def binCenters(bins):
     return (bins[1:] + bins[:-1])/2
 
 def longest_side(tri):
-    def d(x,y):
-        return np.linalg.norm(x-y)
+    return geometry.longest_sides(np.asarray(tri)[np.newaxis])[0]
+
+def _as_paths(paths):
+    return [paths] if isinstance(paths,str) else list(paths)
+
+def _histogram_bins(dimension=3):
+    if dimension == 2:
+        return (np.linspace(0,50,10),np.linspace(0,800))
+    xybins = np.linspace(-50,50,20)
+    return (xybins,xybins,np.linspace(0,800))
 
-    return np.max([d(tri[0],tri[1]),
-                   d(tri[0],tri[2]),
-                   d(tri[0],tri[3]),
-                   d(tri[1],tri[2]),
-                   d(tri[1],tri[3]),
-                   d(tri[2],tri[3])])
+def histogram_events(data_paths,bins,chunksize=1000000,key=None,cols=pos_cols):
+    """Histogram of observed positions (`cols`) in one or more pandas HDF files, reading only the needed columns in chunks
+
+        Returns:
+            the counts and bin edges as returned by `numpy.histogramdd`
+    """
+    hcounts = np.zeros(tuple(len(b) - 1 for b in bins))
+    for path in _as_paths(data_paths):
+        for chunk in read_hdf_chunks(path,columns=cols,chunksize=chunksize,key=key):
+            hcounts += np.histogramdd(chunk.values,bins=bins)[0]
+    return hcounts, list(bins)
 
 from scipy.interpolate import RegularGridInterpolator
-def preprocess_grid(grid, data):
+def _preprocess_grid_hist(grid,hcounts,hbins):
+    interp = RegularGridInterpolator(tuple(binCenters(b) for b in hbins),hcounts,bounds_error=False,fill_value=None)
+    return grid[interp(grid) > np.median(hcounts[hcounts>0])*.5]
+
+def preprocess_grid(grid, data, cols=pos_cols):
     """Remove grid points that fall outside the data
     where outside the data means in histogram bins with less than 0.5*median bin counts
     
     Args:
         grid: the observation space grid points
         data: `pandas.DataFrame` with observed data
+        cols: columns with the observed positions, `pos_cols_2D` for an r-z grid
     
     Returns:
         grid with points outside data removed
     """
-    xybins = np.linspace(-50,50,20)
-    bins = (xybins,xybins,np.linspace(0,800))
-    hcounts, hbins = np.histogramdd(np.array(data[pos_cols]),bins=bins)
-    interp = RegularGridInterpolator(tuple(binCenters(b) for b in hbins),hcounts,bounds_error=False,fill_value=None)
-    return grid[interp(grid) > np.median(hcounts[hcounts>0])*.5]
+    hcounts, hbins = np.histogramdd(np.array(add_derived_columns(data,cols)[cols]),bins=_histogram_bins(len(cols)))
+    return _preprocess_grid_hist(grid,hcounts,hbins)
+
+def preprocess_grid_hdf(grid,data_paths,chunksize=1000000,key=None,cols=pos_cols):
+    """As `preprocess_grid` but reading the observed data from one or more pandas HDF files in chunks"""
+    hcounts, hbins = histogram_events(data_paths,_histogram_bins(len(cols)),chunksize,key,cols)
+    return _preprocess_grid_hist(grid,hcounts,hbins)
 
 from scipy.spatial import Delaunay
 def triangulate_grid(grid):
     """Returns Delaunay triangulation/tetrahedralization of grid points"""
     return Delaunay(grid)
 
-def count_events(triangulation,data):
+def _vertex_cols(triangulation):
+    return ['v{}'.format(i+1) for i in range(triangulation.simplices.shape[1])]
+
+def _count_table(triangulation,counts):
+    simp_counts = pd.DataFrame(triangulation.simplices,columns=_vertex_cols(triangulation))
+    simp_counts['events'] = np.where(counts > 0,counts,np.nan) #as in count_events: no entry for empty simplices
+    return simp_counts
+
+def count_events(triangulation,data,cols=pos_cols):
     """Calculate number of events in each simplex subvolume
     
     Args:
-        triangulation: a `scipy.spatial.Delaunay` object dividing the observation space into simplex subvolumes
+        triangulation: a `scipy.spatial.Delaunay` object dividing the observation space into simplex subvolumes,
+            or a `xedrift.locator.LatticeLocator` for much faster point location in triangulations of lattice points
         data: `pandas.DataFrame` with observed data
+        cols: columns with the observed positions, `pos_cols_2D` for triangles in r-z space
         
     Returns:
         a `pandas.DataFrame` containing the number of events observed in each simplex
     """
-    simp_counts = pd.DataFrame(triangulation.simplices,columns=['v1','v2','v3','v4'])
-    positions_obs = data[pos_cols].values
+    simp_counts = pd.DataFrame(triangulation.simplices,columns=_vertex_cols(triangulation))
+    positions_obs = add_derived_columns(data,cols)[cols].values
     idx, counts = np.unique(triangulation.find_simplex(positions_obs),return_counts=True)
     simp_counts['events'] = pd.DataFrame(counts,index=idx) #idx=-1 is excluded automatically
     return simp_counts
 
-def mask_triangulation(triangulation,grid,simp_counts):
+def count_events_hdf(triangulation,data_paths,chunksize=1000000,key=None,cols=pos_cols):
+    """As `count_events` but reading the observed data from one or more pandas HDF files in chunks, so the data never has to fit into memory
+    
+    Args:
+        triangulation: a `scipy.spatial.Delaunay` object dividing the observation space into simplex subvolumes, or a `xedrift.locator.LatticeLocator`
+        data_paths: path or list of paths to pandas HDF files, the counts of all files are added up
+        chunksize: maximum number of events held in memory
+        key: key of the dataset in the files, the first one if not given
+        cols: columns with the observed positions, `pos_cols_2D` for triangles in r-z space
+        
+    Returns:
+        a `pandas.DataFrame` containing the number of events observed in each simplex, the total number of events read
+    """
+    n_simplices = len(triangulation.simplices)
+    counts = np.zeros(n_simplices + 1,dtype=np.int64) #first entry collects events outside the triangulation (find_simplex returns -1)
+    n_events = 0
+    start_time = time.time()
+    for path in _as_paths(data_paths):
+        for chunk in read_hdf_chunks(path,columns=cols,chunksize=chunksize,key=key):
+            counts += np.bincount(triangulation.find_simplex(chunk.values) + 1,minlength=n_simplices + 1)
+            n_events += len(chunk)
+        print("Counted {} events ({:.2f} s)".format(n_events,time.time() - start_time))
+
+    return _count_table(triangulation,counts[1:]), n_events
+
+def mask_triangulation(triangulation,grid,simp_counts,vol_factor=2,count_sigma=3,max_side=100):
     """Create a mask to remove simplices from the triangulation
     by imposing sanity checks on aspect ratio, volume and event count
     
     Args:
-        triangulation: a `scipy.spatial.Delaunay` object dividing the observation space into simplex subvolumes
+        triangulation: a `scipy.spatial.Delaunay` object dividing the observation space into simplex subvolumes (tetrahedra, or triangles in r-z space)
         grid: the observation space grid points used to build `triangulation`
         simp_counts: a `pandas.DataFrame` returned from `count_events`
+        vol_factor: remove simplices with a volume above vol_factor times the mean volume
+        count_sigma: remove simplices with event counts more than count_sigma standard deviations below the mean
+        max_side: remove simplices with a longer side
         
     Returns:
         a list of booleans corresponding to each simplex in `triangulation`. `True` for simplices that pass the criteria, `False` otherwise.
     """
     simps_coords = grid[triangulation.simplices]
-    simps_vols = volumes3D(simps_coords)
+    simps_vols = geometry.simplex_volumes(simps_coords) #areas for triangles in 2D
     print("Masking {} simplices".format(len(simps_coords)))
 
     tri_mask = simps_vols > 0
     print("{} left after volume > 0".format(sum(tri_mask)))
 
-    tri_mask = tri_mask & (simps_vols < np.mean(simps_vols[tri_mask]) * 2)
-    print("{} left after volume < 2*mean_volume".format(sum(tri_mask)))
+    tri_mask = tri_mask & (simps_vols < np.mean(simps_vols[tri_mask]) * vol_factor)
+    print("{} left after volume < {}*mean_volume".format(sum(tri_mask),vol_factor))
 
     countmean, countstd = simp_counts[tri_mask].events.mean(), simp_counts[tri_mask].events.std()
-    tri_mask = tri_mask & (simp_counts.events > countmean - 3 * countstd)
-    print("{} left after counts > mean counts ({}) - 3 * std ({})".format(sum(tri_mask),countmean,countstd))
+    tri_mask = tri_mask & (simp_counts.events > countmean - count_sigma * countstd)
+    print("{} left after counts > mean counts ({}) - {} * std ({})".format(sum(tri_mask),countmean,count_sigma,countstd))
 
-    tri_mask = tri_mask & (np.array([longest_side(tri) for tri in grid[triangulation.simplices]]) < 100)
-    print("{} left after longest side < 100".format(sum(tri_mask)))
+    tri_mask = tri_mask & (geometry.longest_sides(simps_coords) < max_side)
+    print("{} left after longest side < {}".format(sum(tri_mask),max_side))
     #exclude simps based on longest size in 2d?
 
-    return tri_mask
+    return np.asarray(tri_mask)
+
+#triangulation loaded from the preprocessing cache, has the attributes of a `scipy.spatial.Delaunay` object used for matching
+Triangulation = namedtuple('Triangulation', ['points', 'simplices'])
+
+_preprocessing_version = 1 #increase when the preprocessing steps change to invalidate cached results
+
+def preprocessing_key(data_paths,grid,**mask_params):
+    """Hash identifying the result of `cached_preprocessing`: changes if a data file, the grid or the masking parameters change"""
+    files = []
+    for path in _as_paths(data_paths):
+        stat = os.stat(path)
+        files.append((os.path.abspath(path),stat.st_size,stat.st_mtime_ns))
+    h = hashlib.sha1()
+    h.update(repr((_preprocessing_version,files,sorted(mask_params.items()))).encode())
+    grid = np.ascontiguousarray(grid,dtype=float)
+    h.update(repr(grid.shape).encode())
+    h.update(grid.tobytes())
+    return h.hexdigest()
+
+def cached_preprocessing(data_paths,grid,cache_dir,chunksize=1000000,lattice=True,cols=pos_cols,**mask_params):
+    """Run `preprocess_grid_hdf`, `triangulate_grid`, `count_events_hdf` and `mask_triangulation` for a dataset, or load their results from a cache
+
+    Results are stored in cache_dir in a .npz file named after `preprocessing_key`, so a changed dataset file, grid or masking parameter
+    automatically leads to a new calculation
+
+        Args:
+            data_paths: path or list of paths to pandas HDF files with observed data
+            grid: the observation space grid points before preprocessing
+            cache_dir: folder for cached results
+            chunksize: maximum number of events held in memory
+            cols: columns with the observed positions, `pos_cols_2D` for an r-z grid
+            lattice: if `True`, grid is a (subset of a) rectangular lattice and events are located with a `xedrift.locator.LatticeLocator`
+            mask_params: keyword arguments for `mask_triangulation`
+
+        Returns:
+            the preprocessed grid, the triangulation (`Triangulation`), the event counts (see `count_events`) and the mask (see `mask_triangulation`)
+    """
+    key = preprocessing_key(data_paths,grid,cols=list(cols),**mask_params)
+    cache_path = os.path.join(cache_dir,'preprocessing_{}.npz'.format(key))
+
+    if os.path.exists(cache_path):
+        start_time = time.time()
+        with np.load(cache_path) as cached:
+            if str(cached['key']) == key:
+                grid = cached['grid']
+                triangulation = Triangulation(grid,cached['simplices'])
+                simp_counts = _count_table(triangulation,cached['events'])
+                print("Loaded preprocessing from {} ({:.3f} s)".format(cache_path,time.time() - start_time))
+                return grid, triangulation, simp_counts, cached['tri_mask']
+
+    grid = preprocess_grid_hdf(grid,data_paths,chunksize,cols=cols) #Remove grid points that fall outside the data
+    delaunay = triangulate_grid(grid)
+    locator = LatticeLocator(delaunay) if lattice else delaunay
+    simp_counts, n_events = count_events_hdf(locator,data_paths,chunksize,cols=cols) #count events in observation space simplices
+    tri_mask = mask_triangulation(delaunay,grid,simp_counts,**mask_params) #sanity checks on simplex aspect ratio, volume and event count
+
+    make_dir(cache_dir)
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path,key=key,grid=grid,simplices=delaunay.simplices,events=simp_counts.events.fillna(0).values,tri_mask=tri_mask)
+    os.replace(tmp_path,cache_path) #an interrupted run never leaves an incomplete cache file
+
+    return grid, Triangulation(grid,delaunay.simplices), simp_counts, tri_mask
 
-from collections import namedtuple
 MatchData = namedtuple('MatchData', ['states', 'log_ls', 'accs', 'metas'])
 
-def init_match_data(results_dir, log_l_f, state_0):
+def init_match_data(results_dir, log_l_f, state_0, chain_store=None):
     """Set up result sequence for Metropolis algorithm
     by either loading previous results from file or creating a new file if none exists
     
@@ -289,33 +495,53 @@ def init_match_data(results_dir, log_l_f, state_0):
         results_dir: path to folder where results are (or will be) saved
         log_l_f: log-likelihood function to use
         state_0: initial state vector to use if no previous results exist to be loaded
+        chain_store: a `xedrift.chainStore.ChainStore` to save the chain step by step instead of pickling `MatchData`,
+            an empty store is filled with the results pickled in results_dir if they exist
         
     Returns:
-        `MatchData` namedtuple with lists of state vectors, log-likelihoods, acceptance info and metadata for each step of Metropolis algorithm
+        `MatchData` namedtuple with lists of state vectors, log-likelihoods, acceptance info and metadata for each step of Metropolis algorithm,
+        or chain_store if given
     """
     results_path = results_dir+'/matchresult.p'
     result_loaded = False
 
-    if os.path.exists(results_path):
+    if chain_store is not None and len(chain_store) == 0 and os.path.exists(results_path):
+        match_data = pickle.load(open(results_path,'rb'))['match_data']
+        for state, log_l, accepted, meta in zip(*match_data):
+            chain_store.append(state,log_l,accepted,*meta[:1])
+        print("Copied {} steps from {} to {}".format(len(chain_store),results_path,chain_store.path))
+
+    if chain_store is not None and len(chain_store):
+        match_data = chain_store
+        print("Continuing from {}".format(chain_store.path))
+        result_loaded = True
+    elif chain_store is None and os.path.exists(results_path):
         p_data = pickle.load(open(results_path,'rb'))
         match_data = p_data['match_data']
         print("Continuing from {}".format(results_path))
         result_loaded = True
 
+    if result_loaded:
         #recalculate first log_l in case log_l_f changed since last time
-        match_data.states[-1] = np.clip(match_data.states[-1],None,0)
-        state_0 = match_data.states[-1]
+        state_0 = np.clip(match_data.states[-1],None,0)
+        log_l_loaded = match_data.log_ls[-1]
         print("Starting matching with loaded initial state {}".format(state_0))
         start_time = time.time()
         log_l_0, *meta_0 = log_l_f(state_0)
         time_elapsed = (time.time() - start_time)
-        print("Log-L: {:.2f} (loaded: {:.2f})".format(log_l_0,match_data.log_ls[-1]))
+        print("Log-L: {:.2f} (loaded: {:.2f})".format(log_l_0,log_l_loaded))
         print("Recalculation took {:.2f} s".format(time_elapsed))
 
-        if np.abs(log_l_0 - match_data.log_ls[-1]) > 0.1:
-            match_data.log_ls[-1] = log_l_0
+        if np.abs(log_l_0 - log_l_loaded) > 0.1:
+            log_l_loaded = log_l_0
             print("Loaded Log-L replaced with recalculated value!")
 
+        if chain_store is not None:
+            chain_store.replace_last(state_0,log_l_loaded)
+        else:
+            match_data.states[-1] = state_0
+            match_data.log_ls[-1] = log_l_loaded
+
     if not result_loaded:
         start_time = time.time()
 
@@ -326,6 +552,10 @@ def init_match_data(results_dir, log_l_f, state_0):
         print("First iteration took {:.2f} s".format(time_elapsed))
         #print("avg time/it/grid-point: {:.5f}".format(time_elapsed/len(grid)))
 
+        if chain_store is not None:
+            chain_store.append(state_0,log_l_0,True,*meta_0)
+            return chain_store
+
         match_data = MatchData([],[],[],[])
         match_data.states.append(state_0)
         match_data.log_ls.append(log_l_0)
@@ -336,7 +566,7 @@ def init_match_data(results_dir, log_l_f, state_0):
 
 def r_filter(simps,r_min=0,r_max=np.inf):
     """Slice list of simplices according to radial criteria"""
-    vert_dists = np.linalg.norm(simps[:,:,:2],axis=2)
+    vert_dists = geometry.vertex_radii(simps)
     return np.logical_and(np.min(vert_dists,axis=1) > r_min, np.max(vert_dists,axis=1) < r_max)
 
 def to_polar(x, y):
@@ -347,7 +577,7 @@ def to_polar(x, y):
 
 def center_filter(simps,r_min=0,r_max=np.inf,phi_min=-np.pi,phi_max=np.pi,z_min=-np.inf,z_max=np.inf):
     """Slice list of simplices by center of gravity in cylindrical coordinates"""
-    centers = np.mean(simps,axis=1)
+    centers = geometry.centroids(simps)
     r, phi = to_polar(*centers.T[:2])
     filter_z = (z_min < centers[:,2]) & (z_max > centers[:,2])
     filter_r = (r > r_min) & (r < r_max)
@@ -355,18 +585,28 @@ def center_filter(simps,r_min=0,r_max=np.inf,phi_min=-np.pi,phi_max=np.pi,z_min=
     filter_phi = (phi > phi_min) & (phi < phi_max)
     return filter_phi & filter_r & filter_z
 
-def makeSuperposition(model_path,charges_n_phi,charges_n_z,keep_in_memory=float('inf')):
+def makeSuperposition(model_path,charges_n_phi,charges_n_z,keep_in_memory=float('inf'),dtype=None,rotate_on_the_fly=False,lazy=False):
     """Create a `xedrift.fields.Superposition` object for a model with charge distribution basis vectors corresponding to 'rectangular' wall sections
     
     Args:
         model_path: path to folder where electric field data is stored
         charges_n_phi: number of phi charge sections
         charges_n_z: number of z charge sections
+        keep_in_memory: passed to `xedrift.fields.Superposition`
+        dtype: type to keep the fields in memory with, e.g. `numpy.float32` or `numpy.int16`, passed to `xedrift.fields.Superposition`
+        rotate_on_the_fly: if `True`, only load the unrotated charge fields and use `xedrift.fields.RotatedField` views
+            instead of the rotated files created by `xedrift.fieldRotation.rotateFile`.
+            Use with lazy, otherwise each superposition interpolates every view on the whole grid
+        lazy: passed to `xedrift.fields.Superposition`
         
     Returns:
         a `xedrift.fields.Superposition` object
     """
     fields = [model_path+'/charge_{}/electric_field.txt'.format(i) for i in range(charges_n_z)]
-    fields += [model_path+'/charge_{}/electric_field_rot_{}.txt.npz'.format(i,j) for j in range(1,charges_n_phi) for i in range(charges_n_z)]
+    if rotate_on_the_fly:
+        fields = [Field(f,dtype=dtype) for f in fields]
+        fields += [RotatedField(fields[i],np.radians(j*360/charges_n_phi)) for j in range(1,charges_n_phi) for i in range(charges_n_z)]
+    else:
+        fields += [model_path+'/charge_{}/electric_field_rot_{}.txt.npz'.format(i,j) for j in range(1,charges_n_phi) for i in range(charges_n_z)]
     fields.insert(0,model_path+'/no_charge/electric_field.txt')
-    return Superposition(fields,keep_in_memory)
+    return Superposition(fields,keep_in_memory,lazy=lazy,dtype=dtype)
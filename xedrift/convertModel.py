@@ -0,0 +1,97 @@
+import numpy as np
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import time
+from xedrift.fields import Field, conversion_up_to_date, pack_fields
+
+#this file contains a command line tool to convert all COMSOL exports of a model to .npz files in parallel:
+#python -m xedrift.convertModel models/XE1T_3D_sp_eff_pot_48x6 --memory-budget 16 --pack models/XE1T_3D_sp_eff_pot_48x6/packed
+
+def model_files(model_path):
+    """COMSOL exports of a model in the order used by `xedrift.chargeMatching.makeSuperposition`: the field without charges, then charge_0, charge_1, ...
+    Exports that are only available converted (as electric_field.txt.npz) are included, they are loaded from the .npz files"""
+    charge_dirs = glob.glob(os.path.join(model_path,'charge_*'))
+    charge_dirs = sorted((d for d in charge_dirs if re.match(r'charge_\d+$',os.path.basename(d))),key=lambda d: int(d.split('_')[-1]))
+    files = [os.path.join(model_path,'no_charge','electric_field.txt')] + [os.path.join(d,'electric_field.txt') for d in charge_dirs]
+    return [f for f in files if os.path.exists(f) or os.path.exists(f + '.npz')]
+
+def estimate_memory(filename):
+    """Estimate the memory in bytes needed to convert a COMSOL export from the grid size in its header"""
+    dim_field = 1
+    with open(filename,'r') as file:
+        for line in file:
+            if '% Expressions' in line:
+                dim_field = int(line[-2])
+            if '% Grid' in line:
+                break
+        n_points = 1
+        for line in file:
+            if line.startswith('%'):
+                break
+            n_points *= len(line.split())
+
+    return 2*8*n_points*dim_field #field values and a copy while saving
+
+def _convert(filename):
+    start_time = time.time()
+    Field(filename) #converts to filename.npz
+    return filename, time.time() - start_time
+
+def convert_model(model_path,processes=None,memory_budget=8e9,force=False):
+    """Convert all COMSOL exports of a model to .npz files in parallel, skipping files that were already converted
+
+        Args:
+            model_path: path to folder where electric field data is stored
+            processes: maximum number of worker processes, number of cores if `None`
+            memory_budget: the number of processes is reduced so their estimated memory usage stays below this number of bytes
+            force: convert all files, even if the .npz file is up to date
+
+        Returns:
+            list of the COMSOL exports of the model (see `model_files`)
+    """
+    files = model_files(model_path)
+    if force:
+        for f in files:
+            if os.path.exists(f) and os.path.exists(f + '.npz'): #keep .npz files without an export to convert them from
+                os.remove(f + '.npz')
+    to_convert = [f for f in files if not conversion_up_to_date(f)]
+    print("{} of {} files in {} need to be converted".format(len(to_convert),len(files),model_path))
+    if not to_convert:
+        return files
+
+    per_file = max(estimate_memory(f) for f in to_convert)
+    processes = min(processes or multiprocessing.cpu_count(),len(to_convert),max(1,int(memory_budget//per_file)))
+    print("Converting with {} processes ({:.2f} GB per file)".format(processes,per_file/1e9))
+
+    start_time = time.time()
+    with multiprocessing.Pool(processes) as pool:
+        for idx, (filename, time_elapsed) in enumerate(pool.imap_unordered(_convert,to_convert)):
+            print("[{}/{}] {} ({:.1f} s, total {:.1f} s)".format(idx + 1,len(to_convert),filename,time_elapsed,time.time() - start_time))
+
+    return files
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert the COMSOL exports of a model to .npz files in parallel')
+    parser.add_argument('model_path',help='folder with no_charge/electric_field.txt and charge_i/electric_field.txt')
+    parser.add_argument('--processes',type=int,default=None,help='maximum number of worker processes (default: number of cores)')
+    parser.add_argument('--memory-budget',type=float,default=8,help='memory available for conversion in GB (default: 8)')
+    parser.add_argument('--force',action='store_true',help='convert all files, even if the .npz files are up to date')
+    parser.add_argument('--pack',default=None,help='also write the fields to this folder in the packed format (see xedrift.fields.pack_fields). '
+                        'Packing reads the converted fields again after conversion, and packs only no_charge and the unrotated charge_i fields, '
+                        'not rotated or symmetry basis fields')
+    parser.add_argument('--pack-dtype',default='float64',choices=['float64','float32','int16'],help='type of the packed values (default: float64)')
+    args = parser.parse_args(args)
+
+    files = convert_model(args.model_path,args.processes,args.memory_budget*1e9,args.force)
+    if not files:
+        parser.error("No COMSOL exports or converted .npz files found in {}".format(args.model_path))
+    if args.pack:
+        start_time = time.time()
+        pack_fields(files,args.pack,np.dtype(args.pack_dtype))
+        print("Packed {} fields to {} ({:.1f} s)".format(len(files),args.pack,time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
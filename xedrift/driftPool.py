@@ -0,0 +1,92 @@
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from xedrift.fields import SuperposedField, load_packed
+from xedrift.chargeMatching import make_drifter
+
+#state of each worker process, set up once by _init_worker
+_worker = {}
+
+def _init_worker(basis_spec,grid,components,scales,views,tpc,grid_obs,drift_method):
+    kind, location, shape, dtype = basis_spec
+    if kind == 'packed':
+        basis_values = load_packed(location)[0]
+    else:
+        shm = shared_memory.SharedMemory(name=location)
+        _worker['shm'] = shm #keep the shared memory attached for the lifetime of the worker
+        basis_values = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+
+    _worker.update(basis_values=basis_values,grid=grid,components=components,scales=scales,views=views,
+                   tpc=tpc,grid_obs=grid_obs,drift_method=drift_method)
+
+def _drift_chunk(args):
+    coefficients, start, stop = args
+    field = SuperposedField(_worker['basis_values'],coefficients,_worker['grid'],_worker['components'],_worker['scales'],_worker['views'])
+    drifter = make_drifter(field,_worker['tpc'],_worker['drift_method'])
+    return drifter.driftReverse(_worker['grid_obs'][start:stop])
+
+class DriftPool:
+    """Persistent pool of worker processes for reverse drifting the observation space grid in parallel
+
+    The workers attach to the basis fields once, either to the memory-mapped files of a packed `xedrift.fields.Superposition`
+    or to a copy in shared memory, and evaluate superpositions lazily (see `xedrift.fields.SuperposedField`).
+    For each step only the coefficients and the bounds of the grid chunks are sent to the workers.
+    Can be passed as `pool` to `xedrift.chargeMatching.log_like`
+
+        Args:
+            superpos: the `xedrift.fields.Superposition` with the basis fields
+            tpc: an object specifying the bounds of the TPC and the drift velocity
+            grid_obs: the observation space grid points to reverse-drift
+            processes: number of worker processes, number of cores if `None`
+            drift_method: passed to `xedrift.chargeMatching.make_drifter`
+            chunks_per_process: number of grid chunks per worker and step, more chunks balance the load better
+    """
+    def __init__(self,superpos,tpc,grid_obs,processes=None,drift_method='batch',chunks_per_process=4):
+        self.shm = None
+        if superpos.path is not None:
+            basis_spec = ('packed',superpos.path,None,None)
+        else:
+            basis_spec = self._to_shared_memory(superpos)
+
+        processes = processes or multiprocessing.cpu_count()
+        n_chunks = min(len(grid_obs),processes*chunks_per_process)
+        bounds = np.linspace(0,len(grid_obs),n_chunks + 1).astype(int)
+        self.chunks = list(zip(bounds[:-1],bounds[1:]))
+
+        self.pool = multiprocessing.Pool(processes,initializer=_init_worker,
+                                         initargs=(basis_spec,superpos.grid,superpos.components,superpos.scales,superpos.views,tpc,np.asarray(grid_obs),drift_method))
+
+    def _to_shared_memory(self,superpos):
+        """Copy the basis fields into shared memory, one field at a time"""
+        n_fields = len(superpos.stacked) if superpos.stacked is not None else len(superpos.files)
+        values, factor = superpos._weighted_field(0,1)
+        dtype = values.dtype if superpos.stacked is not None else superpos.dtype
+        shape = (n_fields,) + values.shape
+
+        self.shm = shared_memory.SharedMemory(create=True,size=int(np.prod(shape))*np.dtype(dtype).itemsize)
+        stacked = np.ndarray(shape,dtype=dtype,buffer=self.shm.buf)
+        for idx in range(n_fields):
+            stacked[idx] = superpos.stacked[idx] if superpos.stacked is not None else superpos._weighted_field(idx,1)[0]
+        del stacked
+
+        return ('shm',self.shm.name,shape,dtype)
+
+    def drift(self,coefficients):
+        """Reverse-drift the grid in the superposition with the given coefficients (including the first one, see `xedrift.fields.Superposition.get`)"""
+        coefficients = np.asarray(coefficients,dtype=float)
+        return np.concatenate(self.pool.map(_drift_chunk,[(coefficients,start,stop) for start, stop in self.chunks],chunksize=1))
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        self.pool.close()
+        self.pool.join()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
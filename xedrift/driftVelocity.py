@@ -0,0 +1,74 @@
+import numpy as np
+
+#this file contains drift velocity models, callables taking field strengths (in field units, V/m) and returning drift velocities in cm/s.
+#they accept scalars and arrays, so batch drifters evaluate all particles in one call
+
+#polynomial fit for SR1, drift velocity in mm/µs for field strength in V/cm
+sr1_coefficients = [-0.03522, 0.03884, -0.000417,2.127e-6,-4.164e-9]
+
+class PolynomialDriftVelocity:
+    """Drift velocity given by a polynomial in the field strength, constant above a saturation field strength
+
+        Args:
+            coefficients: polynomial coefficients, lowest order first, for field strength in V/cm and drift velocity in mm/µs
+            e_saturation: field strength in V/cm above which the drift velocity is constant
+            v_saturation: drift velocity in mm/µs above e_saturation
+    """
+    def __init__(self,coefficients=sr1_coefficients,e_saturation=165,v_saturation=1.5):
+        self.coefficients = list(coefficients)
+        self.e_saturation = e_saturation
+        self.v_saturation = v_saturation #1.5: 489
+
+    def __call__(self,e):
+        e = np.asarray(e)/100
+        p = self.coefficients
+        v = p[0]
+        for i in range(1,len(p)):
+            v = v + p[i]*e**i
+        v = np.where(e>self.e_saturation, self.v_saturation, v)
+
+        return v*1e5 #cm/s
+
+class TabulatedDriftVelocity:
+    """Drift velocity interpolated linearly from a table, constant outside the table
+
+        Args:
+            e: ascending field strengths in V/cm
+            v: drift velocities in mm/µs at the field strengths e
+    """
+    def __init__(self,e,v):
+        self.e = np.asarray(e,dtype=float)*100 #field units
+        self.v = np.asarray(v,dtype=float)*1e5 #cm/s
+        if np.any(np.diff(self.e) <= 0):
+            raise ValueError("Field strengths have to be ascending")
+
+    def __call__(self,e):
+        return np.interp(e,self.e,self.v)
+
+def tabulate(drift_velocity,e_max=1000,n=2001):
+    """Precompute a drift velocity model on a table of n field strengths from 0 to e_max V/cm
+
+        Returns:
+            a `TabulatedDriftVelocity`
+    """
+    e = np.linspace(0,e_max,n)
+    return TabulatedDriftVelocity(e,drift_velocity(e*100)/1e5)
+
+def load_drift_velocity(filename):
+    """Load a measured drift velocity curve, e.g. for a different science run or liquid xenon temperature
+
+        Args:
+            filename: .npz file with arrays 'e' and 'v', or text file with two columns,
+                field strength in V/cm and drift velocity in mm/µs (km/s)
+
+        Returns:
+            a `TabulatedDriftVelocity`
+    """
+    if filename.endswith('.npz'):
+        with np.load(filename) as npz:
+            e, v = npz['e'], npz['v']
+    else:
+        e, v = np.loadtxt(filename,unpack=True)
+
+    order = np.argsort(e)
+    return TabulatedDriftVelocity(e[order],v[order])
@@ -26,4 +26,18 @@ def driftRHS_3D(field,drift_velocity,t,x):
     f = field.getValue(x)
     fs = np.sqrt(f[0]**2 + f[1]**2 + f[2]**2)
     f = f/fs
-    return -f*drift_velocity(fs)
\ No newline at end of file
+    return -f*drift_velocity(fs)
+
+def driftRHS_batch(field,drift_velocity,t,x):
+    """The rhs of the equation for drifting along field lines, evaluated for many particles at once
+    
+    Args:
+        field: a `xedrift.fields.Field` object representing the field to drift in
+        drift_velocity: a function giving the drift velocity in the medium dependent on field strength, has to accept arrays
+        t: time, dummy parameter for algorithms that expect explicitly time-dependent rhs
+        x: particle positions, one row per particle
+    """
+    f = field.getValues(x)
+    fs = np.sqrt(np.sum(f**2,axis=1))
+    f = f/fs[:,np.newaxis]
+    return -f*drift_velocity(fs)[:,np.newaxis]
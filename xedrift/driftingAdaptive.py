@@ -0,0 +1,204 @@
+import numpy as np
+import xedrift.drifting as drifting
+from functools import partial
+
+#Dormand-Prince 5(4) coefficients
+_c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+_a = [[],
+      [1/5],
+      [3/40, 9/40],
+      [44/45, -56/15, 32/9],
+      [19372/6561, -25360/2187, 64448/6561, -212/729],
+      [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+      [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+_b = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0]) #5th order solution, same as last row of _a
+_e = _b - np.array([5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40]) #difference to embedded 4th order solution
+
+def _hermite(y0,y1,f0,f1,h,theta):
+    """Cubic Hermite dense output between two steps, theta in [0,1]"""
+    theta = theta[:,np.newaxis]
+    h = h[:,np.newaxis]
+    h00 = (1 + 2*theta)*(1 - theta)**2
+    h10 = theta*(1 - theta)**2
+    h01 = theta**2*(3 - 2*theta)
+    h11 = theta**2*(theta - 1)
+    return h00*y0 + h10*h*f0 + h01*y1 + h11*h*f1
+
+class DriftingAdaptive:
+    """A class for drifting many particles at once along electric field lines using an adaptive Runge-Kutta method
+
+    Uses the embedded Dormand-Prince 5(4) pair with a separate step size for each particle, controlled by the local error estimate.
+    Works in r-z space for 2D fields and in 3D for 3D fields, like `xedrift.driftingBatch.DriftingBatch2D` and `xedrift.driftingBatch.DriftingBatch3D`.
+    Reverse drifting ends exactly at the drift time, drifting to the surface ends exactly at the surface using dense output.
+    Particles that leave the TPC stop just outside the wall or cathode, also found with dense output
+    """
+    def __init__(self,field,tpc,rtol=1e-6,atol=1e-4,h_init=1e-6,h_min=1e-9,h_max=1e-4):
+        """
+            Args:
+                field: a `xedrift.fields.Field` object representing the field to drift in
+                tpc: an object representing the properties of the TPC, i.e. physical dimensions and drift velocity
+                rtol: relative error tolerance per step
+                atol: absolute error tolerance per step in cm
+                h_init: initial time step in seconds
+                h_min: smallest time step in seconds, steps this small are accepted regardless of the error estimate
+                h_max: largest time step in seconds
+        """
+        self.field = field
+        self.tpc = tpc
+        self.dim = field.dim_space
+        self.RHS = partial(drifting.driftRHS_batch,field,tpc.drift_velocity)
+        self.inside = tpc.inside3D if self.dim==3 else tpc.inside
+        self.rtol = rtol
+        self.atol = atol
+        self.h_init = h_init
+        self.h_min = h_min
+        self.h_max = h_max
+        self.n_evaluations = 0 #number of field evaluations, for comparing with other drifters
+
+    def _rhs(self,sign,y):
+        self.n_evaluations += len(y)
+        return sign*self.RHS(0,y)
+
+    def _step(self,sign,y,k1,h):
+        """Single Dormand-Prince step for all given particles, returns new positions, derivatives at the new positions and error estimates"""
+        h = h[:,np.newaxis]
+        ks = [k1]
+        for i in range(1,7):
+            ks.append(self._rhs(sign,y + h*sum(a*k for a, k in zip(_a[i],ks) if a != 0)))
+
+        y_new = y + h*sum(b*k for b, k in zip(_b,ks) if b != 0)
+        err = h*sum(e*k for e, k in zip(_e,ks))
+        return y_new, ks[-1], err
+
+    def _integrate(self,y,s_end,sign,z_stop=None):
+        """Integrate dy/ds = sign*RHS(y) from s=0 to s=s_end for each particle, while inside the TPC
+
+            Args:
+                y: starting positions, one row per particle
+                s_end: end time for each particle in seconds
+                sign: 1 to drift forward, -1 to drift in reverse
+                z_stop: if given, stop particles exactly when their z coordinate rises above z_stop
+
+            Returns:
+                the final positions, the final times, a boolean array indicating which particles reached z_stop
+        """
+        z = self.dim - 1
+        n = len(y)
+        s = np.zeros(n)
+        h = np.full(n,self.h_init)
+        k = np.zeros_like(y)
+        reached = np.zeros(n,dtype=bool)
+
+        active = np.flatnonzero(self.inside(y.T) & (s_end > 0))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            k[active] = self._rhs(sign,y[active])
+            while len(active):
+                ya, ka = y[active], k[active]
+                remaining = s_end[active] - s[active]
+                last = h[active] >= remaining
+                ha = np.where(last,remaining,h[active])
+
+                y_new, k_new, err = self._step(sign,ya,ka,ha)
+
+                scale = self.atol + self.rtol*np.maximum(np.abs(ya),np.abs(y_new))
+                err_norm = np.sqrt(np.mean((err/scale)**2,axis=1))
+                accept = (err_norm <= 1) | (ha <= self.h_min)
+
+                factor = np.clip(0.9*err_norm**-0.2,0.2,5)
+                factor = np.where(np.isnan(factor),0.2,factor)
+                factor = np.where(accept,factor,np.minimum(factor,1))
+                h[active] = np.clip(ha*factor,self.h_min,self.h_max)
+
+                ended = accept & last
+                left = accept & ~self.inside(y_new.T)
+                done = accept & (last | left)
+                crossed = np.zeros(len(active),dtype=bool)
+                if z_stop is not None:
+                    crossed = accept & (y_new[:,z] >= z_stop)
+                    stalled = accept & (y_new[:,z] > z_stop - 0.6) & (k_new[:,z] <= 0) #as in Drifting3D: drift fields interpolated from low resolution data can cause wrong behavior close to the surface
+                    if np.any(crossed):
+                        theta = self._find_crossing(ya[crossed],y_new[crossed],ka[crossed],k_new[crossed],ha[crossed],z_stop)
+                        y_new[crossed] = _hermite(ya[crossed],y_new[crossed],ka[crossed],k_new[crossed],ha[crossed],theta)
+                        ha[crossed] = theta*ha[crossed]
+                    reached[active[crossed | stalled]] = True
+                    ended = ended & ~crossed
+                    done = done | crossed | stalled
+
+                left = left & ~crossed
+                if np.any(left):
+                    #stop just outside the TPC instead of a whole step past the wall or cathode
+                    theta = self._find_exit(ya[left],y_new[left],ka[left],k_new[left],ha[left])
+                    y_new[left] = _hermite(ya[left],y_new[left],ka[left],k_new[left],ha[left],theta)
+                    ha[left] = theta*ha[left]
+                    ended = ended & ~left
+
+                idx = active[accept]
+                y[idx], k[idx] = y_new[accept], k_new[accept]
+                s[idx] += ha[accept]
+                s[active[ended]] = s_end[active[ended]] #avoid rounding errors in the final time
+
+                active = active[~done]
+
+        return y, s, reached
+
+    def _bisect(self,y0,y1,f0,f1,h,before,iterations=40):
+        """Find theta in [0,1] where the dense output between y0 and y1 stops fulfilling `before` (a function of positions with one row per particle),
+        using bisection. Returns the first theta found where it's not fulfilled anymore"""
+        lower = np.zeros(len(y0))
+        upper = np.ones(len(y0))
+        for i in range(iterations):
+            mid = (lower + upper)/2
+            below = before(_hermite(y0,y1,f0,f1,h,mid))
+            lower = np.where(below,mid,lower)
+            upper = np.where(below,upper,mid)
+
+        return upper
+
+    def _find_crossing(self,y0,y1,f0,f1,h,z_stop,iterations=40):
+        """Find theta in [0,1] where the dense output between y0 and y1 crosses z_stop, using bisection"""
+        z = self.dim - 1
+        return self._bisect(y0,y1,f0,f1,h,lambda y: y[:,z] < z_stop,iterations)
+
+    def _find_exit(self,y0,y1,f0,f1,h,iterations=40):
+        """Find theta in [0,1] where the dense output between y0 and y1 leaves the TPC, using bisection"""
+        return self._bisect(y0,y1,f0,f1,h,lambda y: self.inside(y.T),iterations)
+
+    def driftReverse(self,xyt0):
+        """Given observed positions at the liquid surface and drift times, calculate the starting points of the particles by reverse drifting
+
+            Args:
+                xyt0: array with one row per particle of x, y (or r in 2D) and drift time in µs
+
+            Returns:
+                a `numpy.array` containing the starting point of each particle (x, y, z or r, z)
+        """
+        xyt0 = np.atleast_2d(xyt0)
+        y = np.zeros((len(xyt0),self.dim))
+        y[:,:-1] = xyt0[:,:-1]
+        y[:,-1] = 0 if self.dim==3 else self.tpc.z_liquid #same starting plane as the Euler drifters
+
+        y, s, reached = self._integrate(y,xyt0[:,-1]/1e6,-1)
+        return y
+
+    def toSurface(self,x0,t_max=2e-3,z_surface=None):
+        """Drift particles to the liquid surface
+
+            Args:
+                x0: starting positions, one row per particle
+                t_max: maximum drift time in seconds before drifting is aborted
+                z_surface: z coordinate where drifting ends, the liquid surface if not given
+
+            Returns:
+                a `numpy.array` containing the position at the surface (x, y or r) and the drift time in µs for each particle,
+                positions are nan for particles that leave the TPC or don't reach the surface within t_max
+        """
+        x0 = np.atleast_2d(x0)
+        if z_surface is None:
+            z_surface = self.tpc.z_liquid
+
+        y, s, reached = self._integrate(np.array(x0,dtype=float),np.full(len(x0),t_max),1,z_surface)
+
+        result = np.empty((len(x0),self.dim))
+        result[:,:-1] = np.where(reached[:,np.newaxis],y[:,:-1],np.nan)
+        result[:,-1] = s*1e6
+        return result
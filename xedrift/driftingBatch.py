@@ -0,0 +1,97 @@
+import numpy as np
+import xedrift.drifting as drifting
+from functools import partial
+
+class DriftingBatch2D:
+    """A class for drifting many particles at once along electric field lines in r-z space using the Euler method
+    
+    Uses the same step sizes as `xedrift.driftingNaive.Drifting2D`, but advances all particles together as arrays
+    """
+    def __init__(self,field,tpc):
+        """
+            Args:
+                field: a `xedrift.fields.Field` object representing the field to drift in
+                tpc: an object representing the properties of the TPC, i.e. physical dimensions and drift velocity
+        """
+        self.field = field
+        self.tpc = tpc
+        self.RHS = partial(drifting.driftRHS_batch,field,tpc.drift_velocity)
+
+    def driftReverse(self,rt0,dt=1e-6):
+        """Given observed radii at the liquid surface and drift times, calculate the starting points of the particles by reverse drifting
+        
+            Args:
+                rt0: array with one row of r and drift time in µs per particle
+                dt: time step in seconds
+            
+            Returns:
+                a `numpy.array` containing r, z of the starting point for each particle
+        """
+        rt0 = np.atleast_2d(rt0)
+        x = np.empty((len(rt0),2))
+        x[:,0] = rt0[:,0]
+        x[:,1] = self.tpc.z_liquid
+        t = rt0[:,1]/1e6
+        dts = np.full(len(rt0),dt)
+
+        active = np.flatnonzero(self.tpc.inside(x.T) & (t>0))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            while len(active):
+                xa, ta = x[active], t[active]
+                dts[active[(xa[:,1] > -2.0) | (ta < 5e-5)]] = 0.2e-6 #once refined, a particle keeps the small step
+                dta = dts[active]
+
+                xa = xa - dta[:,np.newaxis]*self.RHS(ta,xa)
+                ta = ta - dta
+                x[active], t[active] = xa, ta
+
+                active = active[self.tpc.inside(xa.T) & (ta>0)]
+
+        return x
+
+class DriftingBatch3D:
+    """A class for drifting many particles at once along electric field lines in a TPC in 3D using the Euler method
+    
+    Uses the same step sizes as `xedrift.driftingNaive3D.Drifting3D`, but advances all particles together as arrays.
+    Particles that leave the TPC or reach t=0 are masked out and not advanced any further
+    """
+    def __init__(self,field,tpc):
+        """
+            Args:
+                field: a `xedrift.fields.Field` object representing the field to drift in
+                tpc: an object representing the properties of the TPC, i.e. physical dimensions and drift velocity
+        """
+        self.field = field
+        self.tpc = tpc
+        self.RHS = partial(drifting.driftRHS_batch,field,tpc.drift_velocity)
+
+    def driftReverse(self,xyt0,dt=1e-6):
+        """Given observed x,y-positions at the liquid surface and drift times, calculate the starting points of the particles by reverse drifting
+        
+            Args:
+                xyt0: array with one row of x, y and drift time in µs per particle
+                dt: time step in seconds
+            
+            Returns:
+                a `numpy.array` containing x, y, z of the starting point for each particle
+        """
+        xyt0 = np.atleast_2d(xyt0)
+        x = np.zeros((len(xyt0),3))
+        x[:,:2] = xyt0[:,:2]
+        t = xyt0[:,2]/1e6
+        dts = np.full(len(xyt0),dt)
+
+        active = np.flatnonzero(self.tpc.inside3D(x.T) & (t>0))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            while len(active):
+                xa, ta = x[active], t[active]
+                dts[active[(xa[:,2] < -95.0) | (ta < 2e-5)]] = 0.2e-6 #once refined, a particle keeps the small step
+                dta = dts[active]
+
+                xa = xa - dta[:,np.newaxis]*self.RHS(ta,xa)
+                ta = ta - dta
+                x[active], t[active] = xa, ta
+
+                active = active[self.tpc.inside3D(xa.T) & (ta>0)]
+
+        return x
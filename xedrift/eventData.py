@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+#this file contains helpers to stream large event datasets from pandas HDF files in chunks of bounded size
+
+#columns that are calculated from other columns if they are missing
+derived_columns = {'drift_time_us': ['drift_time'], 'r_observed_nn': ['x_observed_nn','y_observed_nn']}
+
+def add_drift_time_us(data):
+    """Add the 'drift_time_us' column (drift time in µs) calculated from 'drift_time' (in ns) if it's missing"""
+    if 'drift_time_us' not in data.columns and 'drift_time' in data.columns:
+        data['drift_time_us'] = data.drift_time/1e3
+    return data
+
+def add_derived_columns(data,columns=None):
+    """Add the columns in `derived_columns` if they are missing: 'drift_time_us' and the observed radius 'r_observed_nn'
+
+        Args:
+            data: `pandas.DataFrame` with observed data
+            columns: only add these columns, all if `None`
+    """
+    if columns is None or 'drift_time_us' in columns:
+        add_drift_time_us(data)
+    if (columns is None or 'r_observed_nn' in columns) and 'r_observed_nn' not in data.columns and 'x_observed_nn' in data.columns and 'y_observed_nn' in data.columns:
+        data['r_observed_nn'] = np.hypot(data.x_observed_nn,data.y_observed_nn)
+    return data
+
+def _columns_to_read(columns):
+    """Columns to read from file for the requested columns, columns in `derived_columns` are calculated"""
+    if columns is None:
+        return None
+    return list(dict.fromkeys(c for col in columns for c in derived_columns.get(col,[col])))
+
+def _nrows(storer):
+    return storer.nrows if storer.is_table else int(storer.shape[0])
+
+def hdf_length(path,key=None):
+    """Number of events in a pandas HDF file"""
+    with pd.HDFStore(path,mode='r') as store:
+        return _nrows(store.get_storer(key or store.keys()[0]))
+
+def read_hdf_chunks(path,columns=None,chunksize=1000000,key=None):
+    """Iterate over the events in a pandas HDF file in chunks, without loading the whole file into memory
+
+        Only the requested columns are read for files in table format, fixed format files are read chunk by chunk with all columns.
+        The columns in `derived_columns` can be requested for files that don't contain them
+
+        Args:
+            path: path to the HDF file
+            columns: list of columns to return, all columns if `None`
+            chunksize: maximum number of events per chunk
+            key: key of the dataset in the file, the first one if not given
+
+        Yields:
+            `pandas.DataFrame` objects with at most `chunksize` rows
+    """
+    read_columns = _columns_to_read(columns)
+
+    with pd.HDFStore(path,mode='r') as store:
+        key = key or store.keys()[0]
+        storer = store.get_storer(key)
+        for start in range(0,_nrows(storer),chunksize):
+            if storer.is_table:
+                chunk = store.select(key,columns=read_columns,start=start,stop=start+chunksize)
+            else:
+                chunk = store.select(key,start=start,stop=start+chunksize)
+
+            chunk = add_derived_columns(chunk,columns)
+            yield chunk if columns is None else chunk[list(columns)]
@@ -1,4 +1,5 @@
 import numpy as np
+import multiprocessing
 from xedrift.fields import Field
 
 def rot(X,Y,phi):
@@ -6,15 +7,26 @@ def rot(X,Y,phi):
     Yr =  np.sin(phi)*X + np.cos(phi)*Y
     return Xr, Yr
 
-def rotateField(field, phi):
-    """Rotate field around z-axis by angle phi"""
-    X,Y,Z = np.meshgrid(*field.grid,indexing='ij')
+def rotateField(field, phi, block_z=16):
+    """Rotate field around z-axis by angle phi
+    
+        Args:
+            field: the `xedrift.fields.Field` to rotate
+            phi: rotation angle in radians
+            block_z: number of z values rotated at once, limits the memory used in addition to the rotated field
+    """
+    X,Y = np.meshgrid(*field.grid[:2],indexing='ij')
     Xr, Yr = rot(X,Y,-phi) #rotate grid
+    zs = field.grid[2]
 
-    fv = field.getValue((Xr,Yr,Z)) #get field values on rotated grid
-    fX, fY, fZ = fv[:,:,:,0], fv[:,:,:,1], fv[:,:,:,2]
-    fXr, fYr = rot(fX,fY,phi) #rotate field values back to normal coordinate system
-    fvr = np.stack((fXr,fYr,fZ),axis=-1)
+    fvr = np.empty(field.field_values.shape)
+    for start in range(0,len(zs),block_z):
+        Z = zs[start:start+block_z]
+        shape = X.shape + (len(Z),)
+        fv = field.getValue((np.broadcast_to(Xr[...,np.newaxis],shape),np.broadcast_to(Yr[...,np.newaxis],shape),np.broadcast_to(Z,shape))) #get field values on rotated grid
+        fX, fY, fZ = fv[:,:,:,0], fv[:,:,:,1], fv[:,:,:,2]
+        fXr, fYr = rot(fX,fY,phi) #rotate field values back to normal coordinate system
+        fvr[:,:,start:start+block_z] = np.stack((fXr,fYr,fZ),axis=-1)
 
     components=sorted(field.components,key=lambda k:field.components[k])    
 
@@ -23,34 +35,55 @@ def rotateField(field, phi):
 
 import time
 import os
-import gc
 
-def rotateFile(path,steps,start=1,**kwargs):
+_source = {} #field being rotated, shared with the worker processes of rotateFile
+
+def _init_source(path):
+    if _source.get('path') != path: #already inherited from the parent process when forking
+        _source['path'] = path
+        _source['field'] = Field(path)
+
+def _rotate_and_save(args):
+    path, i, steps, block_z = args
+    newpath = path.replace(".txt","_rot_{}.txt".format(i))
+    start = time.time()
+    phi = np.radians(i*360/steps)
+    field_r = rotateField(_source['field'],phi,block_z)
+
+    field_r.save(newpath)
+    del field_r
+    return newpath, time.time() - start
+
+def rotateFile(path,steps,start=1,processes=1,block_z=16,**kwargs):
     """Create copies rotated around z-axis of a file containing field data
         
         Args: 
                 path: path to file
                 steps: rotation angles will be range(1,steps) * 2pi/steps
+                processes: number of angles rotated in parallel, the worker processes share the field read from path
+                block_z: passed to `rotateField`
     """
     if(not ".txt" in path):
         raise ValueError
 
     stop = kwargs.get('stop',steps)
 
-    field = Field(path)
+    _init_source(path)
     print("Processing {} from {} to {}".format(path,start,stop-1))
+    tasks = []
     for i in range(start,stop):
         newpath = path.replace(".txt","_rot_{}.txt".format(i))
         if(os.path.exists(newpath) or os.path.exists(newpath+'.npz')):
             print("Found {}, skipping!".format(newpath))
             continue
-        print("Processing {}".format(newpath))
-        start = time.time()
-        phi = np.radians(i*360/steps)
-        field_r = rotateField(field,phi)
-
-        field_r.save(newpath)
-        del field_r
-        gc.collect()
-        end = time.time()
-        print("Saved {} in {:.2f} seconds".format(newpath,end-start))
\ No newline at end of file
+        tasks.append((path,i,steps,block_z))
+
+    if processes > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(processes,len(tasks)),initializer=_init_source,initargs=(path,)) as pool:
+            for newpath, time_elapsed in pool.imap_unordered(_rotate_and_save,tasks):
+                print("Saved {} in {:.2f} seconds".format(newpath,time_elapsed))
+    else:
+        for task in tasks:
+            print("Processing {}".format(path.replace(".txt","_rot_{}.txt".format(task[1]))))
+            newpath, time_elapsed = _rotate_and_save(task)
+            print("Saved {} in {:.2f} seconds".format(newpath,time_elapsed))
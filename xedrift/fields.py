@@ -1,8 +1,11 @@
 import numpy as np
 import re
-from scipy.interpolate import RegularGridInterpolator
-import copy
+import itertools
 import os.path
+import time
+from collections import namedtuple
+from functools import partial
+from warnings import warn
 
 use_cython = True #use cython for interpolation
 
@@ -10,9 +13,90 @@ try:
     import pyximport; pyximport.install()
     from xedrift.interpolation import trilinear_interpolate4d
 except:
-    warn("Cython import failed, falling back to RegularGridInterpolator")
+    warn("Cython import failed, falling back to numpy interpolation")
     use_cython = False
 
+def _multilinear_corners(positions,steps_inv,edges,shape):
+    """Grid indices and weights of the 2**dim grid points surrounding each position, for multi-linear interpolation on a regular grid
+    
+        Args:
+            positions: array of positions, the last axis holding the coordinates
+            steps_inv: inverse of the grid spacing along each axis
+            edges: first grid value along each axis
+            shape: number of grid points along each axis
+
+        Returns:
+            list of (index tuple, weights) for each corner, weights are zero for positions outside the grid
+    """
+    idx = (np.asarray(positions,dtype=float) - edges)*steps_inv
+    upper = np.array(shape) - 1
+    inside = np.all((idx > -1e-9) & (idx < upper + 1e-9),axis=-1) #tolerance for positions on the grid edges
+    idx = np.where(inside[...,np.newaxis],np.clip(idx,0,upper),0) #also takes care of nan positions
+    lower = np.minimum(np.floor(idx),np.maximum(upper-1,0)).astype(np.intp)
+    rem = idx - lower
+
+    corners = []
+    for corner in itertools.product((0,1),repeat=len(shape)):
+        index = tuple(lower[...,d] + c for d, c in enumerate(corner))
+        weight = inside.astype(float)
+        for d, c in enumerate(corner):
+            weight = weight * (rem[...,d] if c else 1 - rem[...,d])
+        corners.append((index,weight))
+
+    return corners
+
+def multilinear_interpolate(values,positions,steps_inv,edges):
+    """Bi- or trilinear interpolation of field values given on a regular grid, for many positions at once
+    
+        Args:
+            values: array of field values, the first axes are the spatial axes of the grid, the last axis the field components
+            positions: array of positions, the last axis holding the coordinates
+            steps_inv: inverse of the grid spacing along each axis
+            edges: first grid value along each axis
+            
+        Returns:
+            array of interpolated field values, zero for positions outside the grid
+    """
+    dim_space = len(edges)
+    result = 0
+    for index, weight in _multilinear_corners(positions,steps_inv,edges,values.shape[:dim_space]):
+        result = result + weight[...,np.newaxis]*values[index]
+
+    return result
+
+def quantize(values,dtype=np.int16):
+    """Convert field values to integers with a scale for each component, so that values ~= integers * scale
+    
+        The scale maps the largest absolute value of each component to the largest integer, nan values are stored as zero
+
+        Args:
+            values: array of field values, the last axis holding the components
+            dtype: integer type to convert to
+
+        Returns:
+            the integer values, the scale for each component
+    """
+    int_max = np.iinfo(dtype).max
+    result = np.empty(values.shape,dtype=dtype)
+    scale = np.ones(values.shape[-1])
+    for comp in range(values.shape[-1]): #one component at a time to limit memory usage
+        comp_values = values[...,comp]
+        abs_max = np.nanmax(np.abs(comp_values)) if not np.all(np.isnan(comp_values)) else 0
+        if abs_max > 0:
+            scale[comp] = abs_max/int_max
+        result[...,comp] = np.nan_to_num(np.round(comp_values/scale[comp]))
+
+    return result, scale
+
+def dequantize(values,scale,dtype=np.float32):
+    """Convert integer field values produced by `quantize` back to floating point values of type dtype"""
+    return values.astype(dtype)*np.asarray(scale,dtype=dtype)
+
+def conversion_up_to_date(filename):
+    """Whether the .npz file converted from the COMSOL .txt file filename exists and is newer than it"""
+    filename_conv = filename+'.npz'
+    return os.path.exists(filename_conv) and ((not os.path.exists(filename)) or os.path.getmtime(filename) < os.path.getmtime(filename_conv))
+
 class Field:
     """
     Represents a multi-dimensional field given on a grid
@@ -25,6 +109,8 @@ class Field:
         gridspec: Used to pass a list containing grid, field values and field component names if `filename` is `None`
         allow_convert : If `True`, convert COMSOL .txt files to numpy npz format (appending '.npz' to filename),
             or load converted file if it already exists and is newer than .txt file
+        dtype: floating point type used to store the field values in memory, e.g. `numpy.float32` to halve memory usage.
+            Values saved as integers are converted to `numpy.float32` if not given, otherwise the loaded type is kept
     """
 
     def _set_component_index(self,name,index):
@@ -43,56 +129,63 @@ class Field:
         elif(self.dim_space==3):
             self.xs, self.ys, self.zs = self.grid[0], self.grid[1], self.grid[2]
 
-    def _from_comsol_file(self,filename):
-        """Build instance from a COMSOL .txt grid export file"""
-        file = open(filename,'r')
-
-        while True:
-            line = file.readline()
-            if not line:
-                break
+    def _from_comsol_file(self,filename,chunk_rows=100000):
+        """Build instance from a COMSOL .txt grid export file
+        
+        Args:
+            filename: path to the file
+            chunk_rows: number of lines parsed at once, limits the memory used in addition to the field values
+        """
+        start_time = time.time()
+        with open(filename,'r') as file:
+            while True:
+                line = file.readline()
+                if not line:
+                    break
 
-            if '% Dimension' in line:
-                self.dim_space = int(line[-2]) #-1 is \n, -2 is dimension
+                if '% Dimension' in line:
+                    self.dim_space = int(line[-2]) #-1 is \n, -2 is dimension
 
-            if '% Expressions' in line:
-                self.dim_field = int(line[-2]) #-1 is \n, -2 is dimension
+                if '% Expressions' in line:
+                    self.dim_field = int(line[-2]) #-1 is \n, -2 is dimension
 
-            if not self.grid and '% Grid' in line:
-                self.grid = tuple(np.genfromtxt(file,max_rows=1)/10 for i in range(self.dim_space))#convert mm to cm
-                self.shape = tuple(len(dim) for dim in self.grid)
-                self.field_values = np.empty(shape=self.shape+(self.dim_field,))
+                if not self.grid and '% Grid' in line:
+                    self.grid = tuple(np.fromstring(file.readline(),sep=' ')/10 for i in range(self.dim_space))#convert mm to cm
+                    self.shape = tuple(len(dim) for dim in self.grid)
+                    self.field_values = np.empty(shape=self.shape+(self.dim_field,),dtype=self.dtype or float)
 
-                continue
+                    continue
 
-            if '% Data' in line:
-                self._read_comsol_data(file)
-                continue
+                if '% Data' in line:
+                    self._read_comsol_data(file,chunk_rows)
+                    print("Read {} of {} components from {} ({:.1f} s)".format(len(self.components),self.dim_field,filename,time.time() - start_time))
+                    continue
 
-    def _read_comsol_data(self,file):
+    def _read_comsol_data(self,file,chunk_rows=100000):
         """Read actual field data from a COMSOL .txt grid export file"""
         attr = file.readline()
         reg = r'\.(.+?)\s'
         attr = re.search(reg,attr).group(1)
-        
-        numrows = np.prod(self.shape[1:]) #for 2d, read as many rows as there are z values, for 3d, read #y*#z rows
-        #np.genfromtxt is considerate and reads only the lines it needs to, leaving the file handle intact
-        data = np.transpose(np.genfromtxt(file,max_rows=numrows))
-        if(self.dim_space > 2):
-            #‘F’ means to read / write the elements using Fortran-like index order, with the first index changing fastest, and the last index changing slowest.
-            #seems to match comsol behaviour
-            data = np.reshape(data, self.shape,order='F')
-        
+
         comp_idx = len(self.components)
         self._set_component_index(attr,comp_idx)
         comp_slice = self._get_component_slice(comp_idx)
-        self.field_values[comp_slice] = data
+
+        #for 2d, there are as many rows as z values, for 3d #y*#z rows, each with one value per x (or r)
+        #with the first index changing fastest (Fortran order), so the transposed component array is filled in C order
+        layers = self.field_values[comp_slice].transpose() #view with z first, one layer of rows per z value
+        layer_shape = layers.shape[1:]
+        layers_per_chunk = max(1,chunk_rows//int(np.prod(layer_shape[:-1])))
+        for start in range(0,len(layers),layers_per_chunk):
+            n_layers = min(layers_per_chunk,len(layers) - start)
+            lines = itertools.islice(file,n_layers*int(np.prod(layer_shape[:-1])))
+            layers[start:start+n_layers] = np.fromstring(''.join(lines),sep=' ').reshape((n_layers,) + layer_shape)
 
     def _from_grid_values(self,grid,values,components):
         """Build instance from grid and field values as numpy arrays"""
         self.grid = grid
         self.field_values = values
-        self.dim_space = np.shape(grid)[0]
+        self.dim_space = len(grid)
         self.dim_field = values.shape[-1]
         self.shape = tuple(len(dim) for dim in self.grid)
 
@@ -100,29 +193,53 @@ class Field:
             self._set_component_index(comp,comp_idx)
 
     def _from_npz(self,file):
-        """Build instance from a numpy.npz file containing 'grid', 'values' and 'components'"""
+        """Build instance from a numpy.npz file containing 'grid' (or 'grid_0', 'grid_1', ... for axes of different length),
+        'values' and 'components', and 'scale' if the values are stored as integers"""
         npz = np.load(file)
-        self._from_grid_values(npz['grid'],npz['values'],npz['components'])
+        values = npz['values']
+        if 'scale' in npz:
+            values = dequantize(values,npz['scale'],self.dtype or np.float32)
+        if 'grid' in npz:
+            grid = npz['grid']
+        else:
+            grid = tuple(npz['grid_{}'.format(i)] for i in range(values.ndim - 1))
+        self._from_grid_values(grid,values,npz['components'])
 
-    def save(self,file):
-        """Save the field to a numpy .npz file that's smaller and loads faster than a COMSOL .txt file"""
+    def save(self,file,dtype=None):
+        """Save the field to a numpy .npz file that's smaller and loads faster than a COMSOL .txt file
+        
+            Args:
+                file: file name or file object
+                dtype: store the values with this type instead of the type used in memory,
+                    e.g. `numpy.float32`, or `numpy.int16` to store them as integers with a scale for each component (see `quantize`)
+        """
         components=sorted(self.components,key=lambda k:self.components[k])
-        np.savez(file,grid=self.grid,values=self.field_values,components=components)
+        arrays = {}
+        if len(set(len(g) for g in self.grid)) == 1:
+            arrays['grid'] = self.grid
+        else:
+            arrays.update(('grid_{}'.format(i), g) for i, g in enumerate(self.grid)) #axes of different length can't be stored as a single array
+
+        if dtype is not None and np.issubdtype(dtype,np.integer):
+            arrays['values'], arrays['scale'] = quantize(self.field_values,dtype)
+        else:
+            arrays['values'] = self.field_values if dtype is None else self.field_values.astype(dtype,copy=False)
+        np.savez(file,components=components,**arrays)
 
     def _load_or_convert_to_npz(self,filename):
         filename_conv = filename+'.npz'
-        if os.path.exists(filename_conv) and ((not os.path.exists(filename)) or os.path.getmtime(filename) < os.path.getmtime(filename_conv)):
+        if conversion_up_to_date(filename):
             self._from_npz(filename_conv)
         else:
             self._from_comsol_file(filename)
             self.save(filename_conv)
 
-    def __init__(self,filename=None,gridspec=None,allow_convert=True):
+    def __init__(self,filename=None,gridspec=None,allow_convert=True,dtype=None):
         self.components = {}
-        self.interpolator = {}
         self.dim_space = -1
         self.dim_field = -1
         self.grid = None
+        self.dtype = dtype
         
         if filename is None:
             self._from_grid_values(gridspec[0],gridspec[1],gridspec[2])
@@ -136,6 +253,9 @@ class Field:
         else:
             raise ValueError("Invalid file")
 
+        if dtype is not None:
+            self.field_values = self.field_values.astype(dtype,copy=False)
+
         self._finalize()
 
     def _setup_interpolator(self):
@@ -147,10 +267,8 @@ class Field:
         self._grid_steps_inv = 1/self._grid_steps
         self._grid_edges = np.array([g[0] for g in self.grid])
 
-        if self.dim_space == 3 and use_cython:
+        if self.dim_space == 3 and use_cython and self.field_values.dtype == np.float64:
             self.getValue = self._get_value_fast
-        else:
-            self.interpolator = RegularGridInterpolator(self.grid,self.field_values,bounds_error=False,fill_value=0)
 
     def _finalize(self):
         self._setup_interpolator()
@@ -164,12 +282,25 @@ class Field:
             return np.zeros(self.dim_field)
 
     def getValue(self,pos):
-        """Get (interpolated) field value at position pos"""
-        try:
-            return self.interpolator(pos)
-        except ValueError:
-            #print("Error at {}".format(pos))
-            return np.zeros(self.dim_field)
+        """Get (interpolated) field value at position pos
+        
+            Args:
+                pos: a single position or a tuple of coordinate arrays, e.g. from `numpy.meshgrid`
+        """
+        if isinstance(pos,tuple):
+            pos = np.stack(np.broadcast_arrays(*pos),axis=-1)
+        return self.getValues(pos)
+
+    def getValues(self,positions):
+        """Get (interpolated) field values at many positions at once
+        
+            Args:
+                positions: array of positions with one position per row
+                
+            Returns:
+                array of field values with one row per position, zero for positions outside the grid
+        """
+        return multilinear_interpolate(self.field_values,positions,self._grid_steps_inv,self._grid_edges)
 
     def _check_operator_valid(self,other):
         if not isinstance(other,Field):
@@ -178,73 +309,411 @@ class Field:
         if not np.shape(other.field_values) == np.shape(self.field_values):
             raise ValueError("Incompatible field shapes")
 
-    def __add__(self, other):
-        self._check_operator_valid(other)
-            
-        new = copy.deepcopy(self)
-        new.field_values = self.field_values + other.field_values
+    def withValues(self,values):
+        """Create a `Field` with different values on the same grid, sharing the grid and component metadata instead of copying it
         
-        new._finalize()
+            Args:
+                values: field values with the same shape as `field_values`, used without copying
+        """
+        new = Field.__new__(Field)
+        new.components = self.components
+        new.dim_space = self.dim_space
+        new.dim_field = self.dim_field
+        new.grid = self.grid
+        new.shape = self.shape
+        new.dtype = self.dtype
+        new.field_values = values
+        new._grid_steps = self._grid_steps
+        new._grid_steps_inv = self._grid_steps_inv
+        new._grid_edges = self._grid_edges
+        if self.dim_space == 3 and use_cython and values.dtype == np.float64:
+            new.getValue = new._get_value_fast
+        new._set_components_convenience()
+        new._set_grid_convenience()
         return new
+
+    def __add__(self, other):
+        self._check_operator_valid(other)
+        return self.withValues(self.field_values + other.field_values)
     
     def __sub__(self, other):
         self._check_operator_valid(other)
-            
-        new = copy.deepcopy(self)
-        new.field_values = self.field_values - other.field_values
-        
-        new._finalize()
-        return new
+        return self.withValues(self.field_values - other.field_values)
     
     def __rmul__(self, other):
-        if not (isinstance(other,float) or isinstance(other,int)):
+        if not isinstance(other,(float,int,np.number)):
             raise ValueError("Can only multiply field with float or int")
-            
-        new = copy.deepcopy(self)
-        new.field_values = self.field_values * other
-        
-        new._finalize()
-        return new
+        return self.withValues(self.field_values * other)
             
     def __mul__(self, other):
         return self.__rmul__(other)
 
-#could be made smarter with symmetry considerations:
-#rotating is slow so we want to precompute, mirroring might be faster and could be done on the fly
+    def __iadd__(self, other):
+        self._check_operator_valid(other)
+        self.field_values += other.field_values
+        return self
+
+    def __isub__(self, other):
+        self._check_operator_valid(other)
+        self.field_values -= other.field_values
+        return self
+
+    def __imul__(self, other):
+        if not isinstance(other,(float,int,np.number)):
+            raise ValueError("Can only multiply field with float or int")
+        self.field_values *= other
+        return self
+
+    def axpy(self,a,other,out=None):
+        """Calculate self + a*other
+        
+            The product is calculated one slice along the first axis at a time, so no temporary copy of the whole field is needed
+            
+            Args:
+                a: factor for other
+                other: a `Field` with the same shape
+                out: `Field` to write the result to (can be self or other), a new `Field` if `None`
+                
+            Returns:
+                the `Field` containing the result
+        """
+        self._check_operator_valid(other)
+        if out is None:
+            out = self.withValues(np.empty_like(self.field_values))
+        else:
+            self._check_operator_valid(out)
+
+        for idx in range(self.shape[0]):
+            out.field_values[idx] = self.field_values[idx] + a*other.field_values[idx]
+        return out
+
+class RotatedField:
+    """A 3D field rotated around the z axis by an angle, optionally mirrored at the x-z plane (y -> -y) before rotating,
+    without storing the rotated values
+
+    Query positions are transformed back to the original field and the returned vectors are transformed like the field,
+    so `getValues` costs one interpolation of the original field. Rotations by multiples of 90 degrees of fields on grids
+    that are symmetric in x and y map the grid onto itself, `field_values` is then an exact permutation of the original values.
+    Other angles interpolate the original field on the rotated grid, as `xedrift.fieldRotation.rotateField` does.
+    Can be used in place of a `Field` for drifting and in a `Superposition`
+
+        Args:
+            field: the original `Field`, shared between all views of it
+            phi: rotation angle in radians
+            mirror: if `True`, mirror y -> -y before rotating
+    """
+    def __init__(self,field,phi,mirror=False):
+        if field.dim_space != 3:
+            raise ValueError("Only 3D fields can be rotated")
+
+        self.field = field
+        self.phi = phi
+        self.mirror = mirror
+        self.grid = field.grid
+        self.components = field.components
+        self.dim_space = field.dim_space
+        self.dim_field = field.dim_field
+        self.shape = field.shape
+
+        quarter_turns = phi/(np.pi/2)
+        xs, ys = self.grid[0], self.grid[1]
+        symmetric = len(xs) == len(ys) and np.allclose(xs,ys) and np.allclose(xs,-xs[::-1])
+        self.exact = symmetric and np.isclose(quarter_turns,np.round(quarter_turns))
+        self._quarter_turns = int(np.round(quarter_turns)) % 4
+
+        self._rotation = np.array([[np.cos(phi),-np.sin(phi)],[np.sin(phi),np.cos(phi)]])
+        if self.exact:
+            self._rotation = np.round(self._rotation) #exactly 0 and +-1
+        if mirror:
+            self._rotation = self._rotation @ np.diag([1,-1])
+
+    def __repr__(self):
+        return "RotatedField(phi={}, mirror={})".format(self.phi,self.mirror)
+
+    def _transform_vectors(self,values):
+        rotated = values.copy()
+        rotated[...,:2] = values[...,:2] @ self._rotation.T
+        return rotated
+
+    @property
+    def field_values(self):
+        """Values of the rotated field on the grid, calculated each time they are requested"""
+        if self.exact:
+            values = self.field.field_values
+            if self.mirror:
+                values = values[:,::-1]
+            values = np.rot90(values,self._quarter_turns,axes=(0,1))
+            return self._transform_vectors(values)
+
+        X,Y,Z = np.meshgrid(*self.grid,indexing='ij')
+        return self.getValues(np.stack((X,Y,Z),axis=-1))
+
+    def getValue(self,pos):
+        """Get (interpolated) field value at position pos, see `Field.getValue`"""
+        if isinstance(pos,tuple):
+            pos = np.stack(np.broadcast_arrays(*pos),axis=-1)
+        return self.getValues(pos)
+
+    def getValues(self,positions):
+        """Get (interpolated) values of the rotated field at many positions at once, see `Field.getValues`"""
+        positions = np.asarray(positions,dtype=float)
+        original = positions.copy()
+        original[...,:2] = positions[...,:2] @ self._rotation #inverse rotation, the rotation matrix is orthogonal
+        return self._transform_vectors(self.field.getValues(original))
+
+#basis fields that are views of stacked fields: index of the stacked field and of the rotation for each basis field,
+#and the rotation matrices (acting on x, y, see `RotatedField`)
+BasisViews = namedtuple('BasisViews',['base','group','rotations'])
+
+def _basis_views(fields):
+    """Distinct fields and `BasisViews` for a list of fields, files and `RotatedField` views, so views don't need to be stored"""
+    bases, base, group, rotations = [], [], [], []
+    base_ids, rotation_ids = {}, {}
+    for f in fields:
+        original, rotation = (f.field, f._rotation) if isinstance(f,RotatedField) else (f, np.eye(2))
+        key = original if isinstance(original,str) else id(original)
+        if key not in base_ids:
+            base_ids[key] = len(bases)
+            bases.append(original)
+        rotation_key = tuple(np.round(rotation,12).ravel())
+        if rotation_key not in rotation_ids:
+            rotation_ids[rotation_key] = len(rotations)
+            rotations.append(rotation)
+        base.append(base_ids[key])
+        group.append(rotation_ids[rotation_key])
+
+    return bases, BasisViews(np.array(base),np.array(group),np.array(rotations))
+
+class SuperposedField:
+    """A superposition of fields on a common grid that is only evaluated at the positions it is queried at
+
+    Can be used in place of a `Field` for drifting. Instead of summing up all basis fields on the whole grid,
+    `getValues` interpolates the stacked basis fields at the query positions once and contracts them with the coefficients.
+    With `views`, basis fields can be rotated views of the stacked fields, the stacked fields are then interpolated once per rotation
+    at the back-rotated positions
+
+        Args:
+            basis_values: stacked field values of all basis fields, with shape (number of fields,) + grid shape + (field dimension,)
+            coefficients: coefficient for each basis field
+            grid: the grid the basis fields are given on, with ascending values along each axis
+            components: names of the field components
+            scales: for basis values stored as integers, the scale of each component of each stacked field (see `quantize`)
+            views: `BasisViews` if the basis fields are views of the stacked fields, the stacked fields are the basis fields if `None`
+    """
+    def __init__(self,basis_values,coefficients,grid,components,scales=None,views=None):
+        self.basis_values = basis_values
+        self.coefficients = np.asarray(coefficients,dtype=float)
+        self.scales = scales
+        self.views = views
+        self.grid = grid
+        self.components = {comp : comp_idx for comp_idx, comp in enumerate(components)}
+        self.dim_space = len(grid)
+        self.dim_field = basis_values.shape[-1]
+        self.shape = tuple(len(dim) for dim in grid)
+
+        self._grid_steps_inv = 1/np.array([g[1] - g[0] for g in grid])
+        self._grid_edges = np.array([g[0] for g in grid])
+
+    def getValue(self,pos):
+        """Get (interpolated) field value at position pos, see `Field.getValue`"""
+        if isinstance(pos,tuple):
+            pos = np.stack(np.broadcast_arrays(*pos),axis=-1)
+        return self.getValues(pos)
+
+    def getValues(self,positions):
+        """Get (interpolated) values of the superposition at many positions at once, see `Field.getValues`"""
+        nonzero = np.flatnonzero(self.coefficients)
+        if self.views is None:
+            return self._interpolate(nonzero,self.coefficients[nonzero],positions)
+
+        positions = np.asarray(positions,dtype=float)
+        result = 0
+        for g, rotation in enumerate(self.views.rotations):
+            in_group = nonzero[self.views.group[nonzero] == g]
+            if len(in_group) == 0:
+                continue
+            original = positions.copy()
+            original[...,:2] = positions[...,:2] @ rotation #inverse rotation, the rotation matrix is orthogonal
+            values = self._interpolate(self.views.base[in_group],self.coefficients[in_group],original)
+            values[...,:2] = values[...,:2] @ rotation.T
+            result = result + values
+
+        return result
+
+    def _interpolate(self,nonzero,coeffs,positions):
+        """Interpolate the sum of the stacked fields with indices nonzero, weighted with coeffs"""
+        if self.scales is not None:
+            coeffs = coeffs[:,np.newaxis]*self.scales[nonzero] #one coefficient per component
+        nonzero = nonzero.reshape(nonzero.shape + (1,)*(np.ndim(positions)-1)) #broadcast against the position axes
+
+        result = 0
+        for index, weight in _multilinear_corners(positions,self._grid_steps_inv,self._grid_edges,self.shape):
+            corner_values = self.basis_values[(nonzero,) + index] #shape (nonzero coefficients,) + positions shape + (field dimension,)
+            if self.scales is None:
+                corner_values = np.tensordot(coeffs,corner_values,axes=1)
+            else:
+                corner_values = np.einsum('kd,k...d->...d',coeffs,corner_values)
+            result = result + weight[...,np.newaxis]*corner_values
+
+        return result
+
 class Superposition:
     """For calculating superpositions of multiple fields efficiently
     
         Args:
-            field_files: list of .txt or .npz files containing field data
+            field_files: list of .txt or .npz files containing field data (or `Field` and `RotatedField` objects, which keep their type),
+                or path to a directory with fields packed by `pack_fields`, which will be memory-mapped.
+                For lazy superpositions only the fields the `RotatedField` views are based on are stacked and views are evaluated
+                point by point, otherwise `get` calculates the values of each view on the whole grid (slow for angles
+                that are not multiples of 90 degrees, only meant for one-off superpositions)
             keep_in_memory: keep just this number of fields in memory, others will be loaded from disk each time
+            lazy: if `True`, keep all fields stacked in one array and return `SuperposedField` objects
+                that are only evaluated where needed instead of summing up the fields on the whole grid
+            incremental: if `True`, keep the last committed superposition and calculate superpositions that differ
+                in a single coefficient by adding just that field, see `getIncremental`
+            refresh_every: recalculate the committed superposition from scratch after this many incremental commits
+                to avoid accumulating rounding errors
+            dtype: type used to store the fields in memory, e.g. `numpy.float32`,
+                or `numpy.int16` to keep them stacked as integers with a scale per field and component (see `quantize`).
+                Superpositions are calculated with at least single precision. Ignored for packed fields, which keep their stored type
     """
-    def __init__(self,field_files,keep_in_memory=float('inf')):
-        self.files = field_files
-        self.fields = [Field(file) for idx, file in enumerate(field_files) if idx < keep_in_memory]
+    def __init__(self,field_files,keep_in_memory=float('inf'),lazy=False,incremental=False,refresh_every=1000,dtype=None):
+        self.lazy = lazy
+        self.incremental = incremental
+        self.refresh_every = refresh_every
+        self.stacked = None #all fields in a single array, for lazy, packed and integer superpositions
+        self.scales = None #scale for each field and component if stacked as integers
+        self._current = None #committed coefficients and field values for incremental updates
+        self._pending = None #proposed coefficients and field values waiting for commit or rollback
+        self._scratch = None
+        self._commits = 0
+
+        if lazy and incremental:
+            raise ValueError("Lazy superpositions can't be updated incrementally")
+
+        self.fields = []
+        self.path = None #directory of packed fields
+        self.views = None #`BasisViews` if the stacked fields are the originals of `RotatedField` views
+        if isinstance(field_files,str):
+            self.path = field_files
+            self.stacked, self.grid, self.components, self.files, self.scales = load_packed(field_files)
+        elif lazy or (dtype is not None and np.issubdtype(dtype,np.integer)):
+            if keep_in_memory < len(field_files):
+                raise ValueError("Lazy and integer superpositions need all fields in memory")
+            self.files = field_files
+            to_stack = field_files
+            if lazy and any(isinstance(f,RotatedField) for f in field_files):
+                to_stack, self.views = _basis_views(field_files)
+            self.stacked, self.grid, self.components, self.scales = _stack_fields(to_stack,partial(np.empty,dtype=dtype or float),dtype)
+        else:
+            self.files = field_files
+            self.fields = [_load_field(file,dtype) for idx, file in enumerate(field_files) if idx < keep_in_memory]
+            self.grid = self.fields[0].grid
+            self.components = sorted(self.fields[0].components,key=lambda k:self.fields[0].components[k])
+
+        stored_dtype = self.stacked.dtype if self.stacked is not None else self.fields[0].field_values.dtype
+        self.dtype = np.result_type(stored_dtype,np.float32) #type superpositions are calculated with
 
     def get(self,coefficients):
         """Calculate a superposition
         
             Args:
                 coefficients: list of coefficients that each field will be multiplied with, in the order of the files given to the constructor
+
+            Returns:
+                a `Field`, or a `SuperposedField` for lazy superpositions
         """
-        field_values = coefficients[0] * self.fields[0].field_values
+        if self.lazy:
+            return SuperposedField(self.stacked,coefficients,self.grid,self.components,self.scales,self.views)
+        if self.incremental:
+            return self.getIncremental(coefficients)
+
+        return self._get_full(coefficients)
+
+    def _get_full(self,coefficients):
+        values, factor = self._weighted_field(0,coefficients[0])
+        field_values = np.multiply(values,factor,dtype=self.dtype)
         for idx, c in enumerate(coefficients[1:]):
             if c==0:
                 continue
 
-            idx+=1
-            if idx < len(self.fields):
-                field_values += c * self.fields[idx].field_values
-            else:
-                field2 = Field(self.files[idx])
-                field_values += c * field2.field_values
-                del field2
-        
-        components=sorted(self.fields[0].components,key=lambda k:self.fields[0].components[k])
+            values, factor = self._weighted_field(idx+1,c)
+            field_values += values * factor
 
-        return Field(gridspec=(self.fields[0].grid,field_values,components))
+        return self._as_field(field_values)
 
+    def _weighted_field(self,idx,c):
+        """Field values of field idx, loaded from disk if it's not kept in memory,
+        and the factor to multiply them with for coefficient c (one per component for fields stored as integers)"""
+        if self.stacked is not None:
+            if self.scales is not None:
+                return self.stacked[idx], (c*self.scales[idx]).astype(self.dtype)
+            return self.stacked[idx], self.dtype.type(c)
+        if idx < len(self.fields):
+            return self.fields[idx].field_values, self.dtype.type(c)
+        return _load_field(self.files[idx],self.dtype).field_values, self.dtype.type(c)
+
+    def _as_field(self,field_values):
+        return Field(gridspec=(self.grid,field_values,self.components))
+
+    def getIncremental(self,coefficients):
+        """Calculate a superposition as a proposed update to the last committed superposition
+
+            If exactly one coefficient differs from the committed ones, the result is calculated as
+            committed + delta_c * field instead of summing up all fields.
+            The proposal has to be accepted with `commit` or discarded with `rollback`.
+            The first superposition calculated is committed automatically.
+            The returned `Field` shares its values with an internal buffer that gets overwritten by later proposals
+
+            Args:
+                coefficients: list of coefficients that each field will be multiplied with, as for `get`
+        """
+        coefficients = np.array(coefficients,dtype=float)
+
+        if self._current is None:
+            self._current = (coefficients, self._get_full(coefficients).field_values)
+            self._pending = None
+            return self._as_field(self._current[1])
+
+        if self._commits >= self.refresh_every:
+            self._current = (self._current[0], self._get_full(self._current[0]).field_values)
+            self._commits = 0
+
+        current_coeffs, current_values = self._current
+        changed = np.flatnonzero(coefficients != current_coeffs)
+
+        if len(changed) == 0:
+            self._pending = None
+            return self._as_field(current_values)
+
+        if len(changed) == 1:
+            idx = changed[0]
+            if self._scratch is None:
+                self._scratch = np.empty_like(current_values)
+            field_values = self._scratch
+            values, factor = self._weighted_field(idx,coefficients[idx] - current_coeffs[idx])
+            np.multiply(values,factor,out=field_values)
+            field_values += current_values
+        else:
+            field_values = self._get_full(coefficients).field_values
+
+        self._pending = (coefficients, field_values)
+        return self._as_field(field_values)
+
+    def commit(self):
+        """Accept the superposition proposed by the last call to `getIncremental`"""
+        if self._pending is None:
+            return
+
+        if self._pending[1] is self._scratch:
+            self._scratch = self._current[1] #reuse the old values as buffer for the next proposal
+        self._current = self._pending
+        self._pending = None
+        self._commits += 1
+
+    def rollback(self):
+        """Discard the superposition proposed by the last call to `getIncremental`"""
+        self._pending = None
 
     def getWithBase(self,coefficients):
         """As `get` with the first coefficient always set to 1
@@ -252,4 +721,113 @@ class Superposition:
             Args:
                 coefficients: list of coefficients for the remaining fields
         """
-        return self.get(np.concatenate(([1],coefficients)))
\ No newline at end of file
+        return self.get(np.concatenate(([1],coefficients)))
+
+def _load_field(file,dtype=None):
+    """Load a field from a file, fields and views like `RotatedField` are returned as they are"""
+    if isinstance(file,str):
+        return Field(file,dtype=dtype)
+    return file
+
+def _stack_fields(field_files,allocate,dtype=None):
+    """Load fields one at a time into a single array of shape (number of fields,) + grid shape + (field dimension,)
+
+        Args:
+            field_files: list of .txt or .npz files containing field data
+            allocate: function returning the array to fill when called with its shape, e.g. `numpy.empty`
+            dtype: if an integer type, the fields are converted with `quantize`
+
+        Returns:
+            the stacked field values, the grid, the list of component names
+            and the scales for each field and component for integer fields (`None` otherwise)
+    """
+    quantized = dtype is not None and np.issubdtype(dtype,np.integer)
+    scales = None
+
+    for idx, file in enumerate(field_files):
+        field = _load_field(file,None if quantized else dtype)
+        if idx == 0:
+            grid = field.grid
+            components = sorted(field.components,key=lambda k:field.components[k])
+            stacked = allocate((len(field_files),) + field.field_values.shape)
+            if quantized:
+                scales = np.ones((len(field_files),field.dim_field))
+        elif not field.field_values.shape == stacked.shape[1:]:
+            raise ValueError("Incompatible field shapes")
+
+        if quantized:
+            stacked[idx], scales[idx] = quantize(field.field_values,dtype)
+        else:
+            stacked[idx] = field.field_values
+        del field
+
+    return stacked, grid, components, scales
+
+def pack_fields(field_files,path,dtype=np.float64):
+    """Pack fields into a single uncompressed array on disk, so they can be memory-mapped by `Superposition`
+
+        Writes 'values.npy' with all field values and 'meta.npz' with the grid, component names and original files
+        (and scales for integer types) to the directory at path.
+        'meta.npz' is written last, so an interrupted packing is not mistaken for a complete one
+
+        Args:
+            field_files: list of .txt or .npz files containing field data
+            path: directory to write to, created if it doesn't exist
+            dtype: type to store the values with, e.g. `numpy.float32` or `numpy.int16` (see `quantize`)
+    """
+    if len(field_files) == 0:
+        raise ValueError("No fields to pack")
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    meta_path = os.path.join(path,'meta.npz')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    values_path = os.path.join(path,'values.npy')
+    allocate = lambda shape: np.lib.format.open_memmap(values_path,mode='w+',dtype=dtype,shape=shape)
+    stacked, grid, components, scales = _stack_fields(field_files,allocate,dtype)
+    stacked.flush()
+    del stacked
+
+    arrays = {'grid_{}'.format(i) : g for i, g in enumerate(grid)}
+    if scales is not None:
+        arrays['scales'] = scales
+    np.savez(meta_path,components=components,files=[str(f) for f in field_files],**arrays)
+
+def packed_up_to_date(field_files,path):
+    """Whether the fields packed to path with `pack_fields` exist, were packed from field_files and are newer than them
+    (and their converted .npz files), using the same rule as `conversion_up_to_date`"""
+    meta_path = os.path.join(path,'meta.npz')
+    if not os.path.exists(meta_path):
+        return False
+
+    with np.load(meta_path) as meta:
+        if list(meta['files']) != [str(f) for f in field_files]:
+            return False
+
+    packed_time = os.path.getmtime(meta_path)
+    sources = [s for f in field_files if isinstance(f,str) for s in (f, f + '.npz') if os.path.exists(s)]
+    return all(os.path.getmtime(s) < packed_time for s in sources)
+
+def load_packed(path,mmap_mode='r'):
+    """Open fields packed with `pack_fields`
+
+        Args:
+            path: directory the fields were packed to
+            mmap_mode: passed to `numpy.load`, the default opens the values read-only without loading them into memory
+
+        Returns:
+            the memory-mapped stacked field values, the grid, the list of component names, the list of original files
+            and the scales for each field and component if the values are stored as integers (`None` otherwise)
+    """
+    meta_path = os.path.join(path,'meta.npz')
+    if not os.path.exists(meta_path):
+        raise ValueError("No complete packed fields in {}".format(path))
+
+    meta = np.load(meta_path)
+    dim_space = sum(1 for key in meta.files if key.startswith('grid_'))
+    grid = tuple(meta['grid_{}'.format(i)] for i in range(dim_space))
+    stacked = np.load(os.path.join(path,'values.npy'),mmap_mode=mmap_mode)
+    scales = meta['scales'] if 'scales' in meta.files else None
+    return stacked, grid, meta['components'].tolist(), meta['files'].tolist(), scales
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import time
+from xedrift.driftingAdaptive import DriftingAdaptive
+from xedrift.fields import Field
+from xedrift.tpcClass import TPC_X1T
+
+#this file contains a forward simulation of observed events for closure tests of the charge matching:
+#true positions are sampled, drifted to the liquid surface in batches and written to a pandas HDF file chunk by chunk
+#python -m xedrift.forwardSimulation models/XE1T_3D_sp_eff_pot_48x6/no_charge/electric_field.txt data/sim/uniform.hdf --n 10000000
+
+def sample_cylinder(n,tpc,rng,z_max=0):
+    """Sample positions uniformly in the TPC volume (the cylinder r < r_max, z_min < z < z_max)
+
+        Args:
+            n: number of positions
+            tpc: an object with the TPC dimensions r_max and z_min
+            rng: a `numpy.random.Generator`
+            z_max: upper end of the sampled volume, the gate at z = 0 by default
+
+        Returns:
+            array with one row x, y, z per position
+    """
+    r = tpc.r_max*np.sqrt(rng.random(n))
+    phi = rng.uniform(-np.pi,np.pi,n)
+    z = rng.uniform(tpc.z_min,z_max,n)
+    return np.column_stack((r*np.cos(phi),r*np.sin(phi),z))
+
+def drift_to_surface(drifter,x0):
+    """Drift true positions (x, y, z) to the surface, also for drifters with 2D (r-z) fields, where the observed position keeps the azimuth of the true position
+
+        Args:
+            drifter: a `xedrift.driftingAdaptive.DriftingAdaptive` drifter
+            x0: array with one row x, y, z per particle
+
+        Returns:
+            array with one row of observed x, y and drift time in µs per particle, positions are nan for lost particles
+    """
+    if drifter.dim == 3:
+        return drifter.toSurface(x0,z_surface=0) #same plane as the start of reverse drifting
+
+    r = np.hypot(x0[:,0],x0[:,1])
+    rt = drifter.toSurface(np.column_stack((r,x0[:,2])))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        scale = np.where(r > 0,rt[:,0]/r,0)
+    return np.column_stack((x0[:,0]*scale,x0[:,1]*scale,rt[:,1]))
+
+def simulate_events(field,tpc,out_path,n_events,batch_size=100000,sampler=None,seed=None,key='events',append=False,**drifter_kwargs):
+    """Simulate observed events by drifting sampled true positions to the surface, written to a pandas HDF file in table format batch by batch
+
+        The file has the columns read by `xedrift.chargeMatching` (x_observed_nn, y_observed_nn, drift_time in ns and drift_time_us)
+        and the true positions x, y, z. Particles that leave the TPC or don't reach the surface are dropped.
+        Only one batch is kept in memory
+
+        Args:
+            field: a `xedrift.fields.Field` object representing the drift field, 2D (r-z) or 3D
+            tpc: an object representing the properties of the TPC, i.e. physical dimensions and drift velocity
+            out_path: path to the HDF file
+            n_events: number of true positions to simulate
+            batch_size: number of particles drifted together
+            sampler: function of (n, rng) returning true positions with one row x, y, z, uniform in the TPC (`sample_cylinder`) if not given
+            seed: seed for `numpy.random.default_rng`
+            key: key of the dataset in the file
+            append: append to an existing file instead of overwriting it
+            **drifter_kwargs: passed to `xedrift.driftingAdaptive.DriftingAdaptive`, e.g. rtol and atol
+
+        Returns:
+            number of events written
+    """
+    rng = np.random.default_rng(seed)
+    if sampler is None:
+        sampler = lambda n, rng: sample_cylinder(n,tpc,rng)
+    drifter = DriftingAdaptive(field,tpc,**drifter_kwargs)
+
+    if not append and os.path.exists(out_path):
+        os.remove(out_path)
+
+    n_written = 0
+    start_time = time.time()
+    with pd.HDFStore(out_path,mode='a') as store:
+        for start in range(0,n_events,batch_size):
+            x0 = sampler(min(batch_size,n_events - start),rng)
+            xyt = drift_to_surface(drifter,x0)
+            reached = ~np.isnan(xyt[:,0])
+
+            events = pd.DataFrame({'x_observed_nn': xyt[reached,0],
+                                   'y_observed_nn': xyt[reached,1],
+                                   'drift_time': xyt[reached,2]*1e3, #ns
+                                   'drift_time_us': xyt[reached,2],
+                                   'x': x0[reached,0],
+                                   'y': x0[reached,1],
+                                   'z': x0[reached,2]})
+            store.append(key,events,format='table',index=False)
+            n_written += len(events)
+            print("[{}/{}] {} events written, {} lost ({:.1f} s)".format(start + len(x0),n_events,n_written,start + len(x0) - n_written,time.time() - start_time))
+
+    return n_written
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Simulate observed events uniformly distributed in the TPC by drifting them in a field')
+    parser.add_argument('field',help='electric field file (COMSOL export or .npz)')
+    parser.add_argument('out',help='HDF file for the simulated events')
+    parser.add_argument('--n',type=int,default=1000000,help='number of events to simulate (default: 1000000)')
+    parser.add_argument('--batch-size',type=int,default=100000,help='number of events drifted together (default: 100000)')
+    parser.add_argument('--seed',type=int,default=None,help='random seed')
+    parser.add_argument('--rtol',type=float,default=1e-6,help='relative error tolerance per drift step (default: 1e-6)')
+    parser.add_argument('--atol',type=float,default=1e-4,help='absolute error tolerance per drift step in cm (default: 1e-4)')
+    parser.add_argument('--append',action='store_true',help='append to an existing file')
+    args = parser.parse_args(args)
+
+    out_dir = os.path.dirname(args.out)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    simulate_events(Field(args.field),TPC_X1T(),args.out,args.n,args.batch_size,seed=args.seed,append=args.append,rtol=args.rtol,atol=args.atol)
+
+if __name__ == '__main__':
+    main()
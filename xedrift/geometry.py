@@ -0,0 +1,69 @@
+import numpy as np
+import itertools
+from math import factorial
+
+#this file contains vectorized geometry for arrays of simplices with shape (n_simplices, n_vertices, dimension),
+#e.g. `grid[triangulation.simplices]`
+
+def signed_volumes(simps):
+    """Signed volumes of simplices (areas of triangles in 2D) from the determinant of their edge vectors, the sign gives the orientation of the vertices"""
+    edges = simps[:,1:] - simps[:,:1]
+    return np.linalg.det(edges)/factorial(simps.shape[-1])
+
+def longest_sides(simps):
+    """Length of the longest edge of each simplex"""
+    return np.max(edge_lengths(simps),axis=1)
+
+def edge_lengths(simps):
+    """Lengths of all edges of each simplex, one column per pair of vertices"""
+    pairs = np.array(list(itertools.combinations(range(simps.shape[1]),2)))
+    return np.linalg.norm(simps[:,pairs[:,0]] - simps[:,pairs[:,1]],axis=2)
+
+def simplex_volumes(simps,rtol=1e-10):
+    """Volumes of simplices (areas of triangles in 2D), -1 for degenerate (flat) simplices
+
+        Args:
+            simps: array of simplices with shape (n, dimension + 1, dimension)
+            rtol: simplices with a volume below rtol times their longest side to the power of the dimension are degenerate
+
+        Returns:
+            array with the volume of each simplex
+    """
+    volumes = np.abs(signed_volumes(simps))
+    degenerate = ~(volumes > rtol*longest_sides(simps)**simps.shape[-1]) #also catches nan vertices
+    return np.where(degenerate,-1,volumes)
+
+def tetra_volumes(simps,rtol=1e-10):
+    """Volumes of tetrahedra with shape (n, 4, 3), see `simplex_volumes`"""
+    return simplex_volumes(simps,rtol)
+
+def inverted(simps,simps_ref):
+    """Boolean array, `True` for simplices whose orientation relative to the corresponding reference simplices differs from the majority,
+    e.g. simplices of the observation space grid that are turned inside out by reverse drifting
+    (drift time increases downwards, so reverse drifting flips the orientation of all simplices that are not inverted)"""
+    relative = np.sign(signed_volumes(simps))*np.sign(signed_volumes(simps_ref))
+    return relative != (1 if np.sum(relative) >= 0 else -1)
+
+def rz_volumes(simps):
+    """Volumes of the solids generated by rotating triangles in r-z space around the z axis (divided by pi)
+
+        Uses the integral of r^2 dz along each edge, summed cyclically around the triangle, so the vertices don't need to be sorted.
+
+        Args:
+            simps: array of triangles with shape (n, 3, 2) with columns r, z
+
+        Returns:
+            array with the volume of each triangle
+    """
+    r0, z0 = simps[:,:,0], simps[:,:,1]
+    r1, z1 = np.roll(r0,-1,axis=1), np.roll(z0,-1,axis=1)
+    rsqint = (z1 - z0)*(r0**2 + r0*r1 + r1**2)/3
+    return np.abs(np.sum(rsqint,axis=1))
+
+def centroids(simps):
+    """Centers of gravity of the vertices of each simplex"""
+    return np.mean(simps,axis=1)
+
+def vertex_radii(simps):
+    """Distance of each vertex from the z axis, with shape (n_simplices, n_vertices)"""
+    return np.linalg.norm(simps[:,:,:2],axis=2)
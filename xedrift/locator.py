@@ -0,0 +1,106 @@
+import numpy as np
+
+class LatticeLocator:
+    """Point location for triangulations of (a subset of) a rectangular lattice, e.g. the observation space grid
+
+    Each simplex is registered in all lattice cells its bounding box overlaps. Points are assigned to their cell by arithmetic
+    and then tested against the few simplices registered in that cell with barycentric coordinates.
+    Has the attributes of `scipy.spatial.Delaunay` used for matching, so it can be passed to `xedrift.chargeMatching.count_events` instead
+
+        Args:
+            triangulation: a `scipy.spatial.Delaunay` object or `xedrift.chargeMatching.Triangulation` built from lattice points
+            axes: list of the lattice coordinates along each axis, the unique coordinates of the triangulation points if not given
+            eps: tolerance for the barycentric coordinates, points on faces between simplices belong to either of them
+    """
+    def __init__(self,triangulation,axes=None,eps=1e-10):
+        self.points = np.asarray(triangulation.points,dtype=float)
+        self.simplices = np.asarray(triangulation.simplices)
+        self.eps = eps
+        n_simplices, n_vertices = self.simplices.shape
+        self.dim = n_vertices - 1
+
+        if axes is None:
+            axes = [np.unique(self.points[:,d]) for d in range(self.dim)]
+        self.axes = [np.asarray(a,dtype=float) for a in axes]
+        self.shape = tuple(len(a) - 1 for a in self.axes) #number of cells along each axis
+        steps = [np.diff(a) for a in self.axes]
+        self._uniform = all(np.allclose(s,s[0]) for s in steps)
+        self._steps = np.array([s[0] for s in steps])
+        self._lower = np.array([a[0] for a in self.axes])
+        self._upper = np.array([a[-1] for a in self.axes])
+
+        self._setup_transform()
+        self._setup_buckets()
+
+    def _setup_transform(self):
+        """Affine transformation to barycentric coordinates for each simplex, like `scipy.spatial.Delaunay.transform`"""
+        verts = self.points[self.simplices]
+        self._origin = verts[:,-1]
+        T = np.transpose(verts[:,:-1] - self._origin[:,np.newaxis],(0,2,1))
+        regular = np.abs(np.linalg.det(T)) > 1e-12*np.max(np.abs(T),axis=(1,2))**self.dim
+        self._Tinv = np.full(T.shape,np.nan) #degenerate simplices never contain points
+        self._Tinv[regular] = np.linalg.inv(T[regular])
+
+    def _setup_buckets(self):
+        """Sorted list of simplex indices for each cell, in CSR format"""
+        verts = self.points[self.simplices]
+        lo = np.stack([np.searchsorted(a,verts[:,:,d].min(axis=1) + 1e-9*self._steps[d]) - 1 for d, a in enumerate(self.axes)],axis=1)
+        hi = np.stack([np.searchsorted(a,verts[:,:,d].max(axis=1) - 1e-9*self._steps[d]) - 1 for d, a in enumerate(self.axes)],axis=1)
+        lo = np.clip(lo,0,np.array(self.shape) - 1)
+        hi = np.clip(hi,lo,np.array(self.shape) - 1)
+
+        extent = hi - lo + 1
+        n_cells = np.prod(extent,axis=1)
+        simplex_ids = np.repeat(np.arange(len(self.simplices)),n_cells)
+        local = np.arange(len(simplex_ids)) - np.repeat(np.cumsum(n_cells) - n_cells,n_cells)
+        cell_idx = np.empty((len(simplex_ids),self.dim),dtype=int)
+        for d in reversed(range(self.dim)):
+            cell_idx[:,d] = lo[simplex_ids,d] + local % extent[simplex_ids,d]
+            local //= extent[simplex_ids,d]
+        cells = np.ravel_multi_index(cell_idx.T,self.shape)
+
+        order = np.lexsort((simplex_ids,cells))
+        self._bucket = simplex_ids[order]
+        self._bucket_count = np.bincount(cells,minlength=int(np.prod(self.shape)))
+        self._bucket_start = np.cumsum(self._bucket_count) - self._bucket_count
+
+    def _cells(self,points):
+        """Flat index of the lattice cell for each point"""
+        if self._uniform:
+            idx = np.floor((points - self._lower)/self._steps).astype(int)
+        else:
+            idx = np.stack([np.searchsorted(a,points[:,d],side='right') - 1 for d, a in enumerate(self.axes)],axis=1)
+        idx = np.clip(idx,0,np.array(self.shape) - 1) #points on the upper boundary belong to the last cell
+        return np.ravel_multi_index(idx.T,self.shape)
+
+    def find_simplex(self,points):
+        """Find the simplices containing the given points, same as `scipy.spatial.Delaunay.find_simplex`
+
+            Args:
+                points: array with one row per point
+
+            Returns:
+                array with the index of the simplex containing each point, -1 for points outside the triangulation
+        """
+        points = np.asarray(points,dtype=float)
+        result = np.full(len(points),-1)
+
+        inside = np.all((points >= self._lower - self.eps) & (points <= self._upper + self.eps),axis=1)
+        remaining = np.flatnonzero(inside) #points not assigned yet
+        cells = self._cells(points[remaining])
+        starts, counts = self._bucket_start[cells], self._bucket_count[cells]
+
+        k = 0
+        while len(remaining):
+            candidates = counts > k
+            remaining, starts, counts = remaining[candidates], starts[candidates], counts[candidates]
+            simps = self._bucket[starts + k]
+
+            bary = np.einsum('nij,nj->ni',self._Tinv[simps],points[remaining] - self._origin[simps])
+            found = np.all(bary >= -self.eps,axis=1) & (np.sum(bary,axis=1) <= 1 + self.eps)
+            result[remaining[found]] = simps[found]
+
+            remaining, starts, counts = remaining[~found], starts[~found], counts[~found]
+            k += 1
+
+        return result
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import time
+from xedrift.fields import Field
+from xedrift.chargeMatching import make_drifter, pos_cols
+from xedrift.eventData import read_hdf_chunks
+
+#columns added to event data by `CorrectionMap.correctData`
+corrected_cols = ['x_corrected','y_corrected','z_corrected']
+
+class CorrectionMap:
+    """Map from observed positions (x, y, drift time) to true positions (x, y, z) in the TPC
+
+    The map is given on a regular lattice in observation space, usually calculated with `build_correction_map`,
+    and applied to events by trilinear interpolation. Lattice points whose reverse-drifted position is outside the TPC are nan,
+    so are events in lattice cells next to them and events outside the lattice
+
+        Args:
+            filename: .npz file saved with `save` to load the map from
+            gridspec: list containing the lattice axes (x, y, drift time in µs) and the true positions on the lattice
+                with shape (nx, ny, nt, 3), if filename is `None`
+    """
+    def __init__(self,filename=None,gridspec=None):
+        if filename is None:
+            axes, positions = gridspec
+            self.map = Field(gridspec=(tuple(axes),positions,['x','y','z']))
+        else:
+            self.map = Field(filename)
+
+        self._lower = np.array([g[0] for g in self.map.grid])
+        self._upper = np.array([g[-1] for g in self.map.grid])
+
+    def save(self,file):
+        """Save the map to a numpy .npz file"""
+        self.map.save(file)
+
+    def correct(self,positions_obs):
+        """Get the true positions for observed positions
+
+            Args:
+                positions_obs: array with one row of x, y and drift time in µs per event
+
+            Returns:
+                array with one row of x, y, z per event
+        """
+        positions_obs = np.asarray(positions_obs,dtype=float)
+        result = self.map.getValues(positions_obs)
+        outside = np.any((positions_obs < self._lower - 1e-9) | (positions_obs > self._upper + 1e-9),axis=-1)
+        result[outside] = np.nan
+        return result
+
+    def correctData(self,data,cols=pos_cols):
+        """Add the columns in `corrected_cols` with the true positions to a `pandas.DataFrame` with observed events
+
+            Args:
+                data: `pandas.DataFrame` with observed data
+                cols: names of the columns with observed x, y and drift time in µs
+        """
+        positions = self.correct(data[cols].values)
+        for idx, col in enumerate(corrected_cols):
+            data[col] = positions[:,idx]
+        return data
+
+def build_correction_map(field,tpc,xs,ys,ts,drift_method='batch',chunksize=100000):
+    """Calculate a `CorrectionMap` by reverse drifting all points of a regular lattice in observation space once
+
+        Args:
+            field: the drift field, e.g. a superposition with fitted coefficients
+            tpc: an object specifying the bounds of the TPC and the drift velocity
+            xs, ys, ts: ascending lattice axes for x, y and drift time in µs
+            drift_method: passed to `xedrift.chargeMatching.make_drifter`
+            chunksize: number of lattice points drifted together, to limit memory usage
+
+        Returns:
+            a `CorrectionMap`
+    """
+    lattice = np.stack(np.meshgrid(xs,ys,ts,indexing='ij'),axis=-1).reshape(-1,3)
+    drifter = make_drifter(field,tpc,drift_method)
+
+    start_time = time.time()
+    positions = np.empty_like(lattice)
+    for start in range(0,len(lattice),chunksize):
+        positions[start:start+chunksize] = drifter.driftReverse(lattice[start:start+chunksize])
+    positions[~tpc.inside3D(positions.T)] = np.nan
+    print("Drifted {} lattice points in {:.2f} s".format(len(lattice),time.time() - start_time))
+
+    return CorrectionMap(gridspec=((xs,ys,ts),positions.reshape((len(xs),len(ys),len(ts),3))))
+
+def map_error(correction_map,field,tpc,positions_obs,drift_method='batch'):
+    """Compare the positions given by a `CorrectionMap` with directly reverse-drifted positions, to choose the lattice resolution
+
+        Args:
+            correction_map: the `CorrectionMap` to check
+            field: the drift field the map was built from
+            tpc: an object specifying the bounds of the TPC and the drift velocity
+            positions_obs: sample of observed positions, one row of x, y and drift time in µs per event
+            drift_method: passed to `xedrift.chargeMatching.make_drifter`
+
+        Returns:
+            the distance between mapped and directly drifted position for each event, nan where either is invalid
+    """
+    positions_obs = np.asarray(positions_obs,dtype=float)
+    direct = make_drifter(field,tpc,drift_method).driftReverse(positions_obs)
+    direct[~tpc.inside3D(direct.T)] = np.nan
+    dists = np.linalg.norm(correction_map.correct(positions_obs) - direct,axis=1)
+
+    valid = dists[~np.isnan(dists)]
+    if len(valid):
+        print("Map vs. direct drift for {} events: mean {:.4f} cm, 95% {:.4f} cm, max {:.4f} cm, {} invalid".format(
+            len(dists),np.mean(valid),np.percentile(valid,95),np.max(valid),len(dists) - len(valid)))
+    return dists
+
+def correct_hdf(correction_map,path,out_path,cols=pos_cols,chunksize=1000000,key=None,out_key='events'):
+    """Apply a `CorrectionMap` to all events in a pandas HDF file, reading and writing it in chunks
+
+        Args:
+            correction_map: the `CorrectionMap` to apply
+            path: HDF file with observed events
+            out_path: HDF file to append the events with the columns in `corrected_cols` added to (in table format)
+            cols: names of the columns with observed x, y and drift time in µs
+            chunksize: maximum number of events held in memory
+            key: key of the dataset in the input file, the first one if not given
+            out_key: key of the dataset in the output file
+    """
+    start_time = time.time()
+    n_events = 0
+    with pd.HDFStore(out_path,mode='a') as out:
+        for chunk in read_hdf_chunks(path,chunksize=chunksize,key=key):
+            correction_map.correctData(chunk,cols)
+            out.append(out_key,chunk,format='table',index=False)
+            n_events += len(chunk)
+            print("Corrected {} events ({:.2f} s)".format(n_events,time.time() - start_time))
@@ -0,0 +1,121 @@
+import numpy as np
+import argparse
+import json
+import os
+import time
+from functools import partial
+import xedrift.symmetry as symmetry
+from xedrift.fields import Field, RotatedField
+
+#this file contains a tool to build reduced basis fields for fitting with symmetries from the charge fields of a model:
+#python -m xedrift.symmetryBasis models/XE1T_3D_sp_eff_pot_48x6 --scheme n_sliding_only --n 6
+
+#symmetry schemes from xedrift.symmetry: function of (n_phi, n_z, n) returning the expansion function and the number of reduced coefficients
+schemes = {
+    'n_sliding_only': lambda n_phi, n_z, n: (partial(symmetry.n_sliding_only,n_phi,n_z,n), n*n_z),
+    'single_fixed_n_sliding': lambda n_phi, n_z, n: (partial(symmetry.single_fixed_n_sliding,n_phi,n_z,n), (n+1)*n_z),
+    'sliding_fixed_foreach_z': lambda n_phi, n_z, n: (partial(symmetry.sliding_fixed_foreach_z,n_phi), 2*n_z),
+}
+
+def expansion_matrix(expand,n_reduced):
+    """Matrix M with M[full index, reduced index], so that expand(coeffs) == M @ coeffs for the linear expansion functions in `xedrift.symmetry`
+
+        The full index of the charge field of z section i rotated by j phi steps is j*n_z + i, as in `xedrift.chargeMatching.makeSuperposition`
+    """
+    columns = []
+    for k in range(n_reduced):
+        unit = [0]*n_reduced
+        unit[k] = 1
+        columns.append(np.array(expand(unit),dtype=float))
+    return np.stack(columns,axis=1)
+
+class ChargeFields:
+    """Charge fields of a model by full index, only the unrotated fields are loaded and rotated by `xedrift.fields.RotatedField`,
+    or rotated fields are loaded from the files created by `xedrift.fieldRotation.rotateFile` one at a time"""
+    def __init__(self,model_path,n_phi,n_z,rotate_on_the_fly=True):
+        self.model_path = model_path
+        self.n_phi = n_phi
+        self.n_z = n_z
+        self.rotate_on_the_fly = rotate_on_the_fly
+        self.charge_fields = [Field(model_path+'/charge_{}/electric_field.txt'.format(i)) for i in range(n_z)] if rotate_on_the_fly else None
+        first = self.charge_fields[0] if rotate_on_the_fly else Field(model_path+'/charge_0/electric_field.txt')
+        self.grid = first.grid
+        self.components = sorted(first.components,key=lambda k:first.components[k])
+
+    def values(self,index):
+        j, i = divmod(index,self.n_z)
+        if j == 0 and self.rotate_on_the_fly:
+            return self.charge_fields[i].field_values
+        if self.rotate_on_the_fly:
+            return RotatedField(self.charge_fields[i],np.radians(j*360/self.n_phi)).field_values
+        if j == 0:
+            return Field(self.model_path+'/charge_{}/electric_field.txt'.format(i)).field_values
+        return Field(self.model_path+'/charge_{}/electric_field_rot_{}.txt.npz'.format(i,j)).field_values
+
+def build_symmetry_basis(model_path,out_dir,scheme,n_phi,n_z,n,rotate_on_the_fly=True,force=False):
+    """Build the reduced basis fields for a symmetry scheme by summing the charge fields each reduced coefficient expands to
+
+        Basis fields are calculated and saved one at a time as out_dir/field_k.npz, existing files are skipped unless force is `True`.
+        The scheme, its parameters and the expansion matrix are saved to out_dir/symmetry.json
+
+        Args:
+            model_path: path to folder where electric field data is stored
+            out_dir: folder for the basis fields
+            scheme: name of the symmetry scheme in `schemes`
+            n_phi: number of phi charge sections
+            n_z: number of z charge sections
+            n: number of sliding reflectors per symmetry unit, passed to the scheme
+            rotate_on_the_fly: passed to `ChargeFields`
+            force: rebuild existing basis fields
+
+        Returns:
+            list of the basis field files
+    """
+    expand, n_reduced = schemes[scheme](n_phi,n_z,n)
+    matrix = expansion_matrix(expand,n_reduced)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    with open(os.path.join(out_dir,'symmetry.json'),'w') as f:
+        json.dump({'model_path': model_path, 'scheme': scheme, 'n_phi': n_phi, 'n_z': n_z, 'n': n, 'matrix': matrix.tolist()},f)
+
+    files = [os.path.join(out_dir,'field_{}.npz'.format(k)) for k in range(n_reduced)]
+    charges = None
+    for k, file in enumerate(files):
+        if os.path.exists(file) and not force:
+            print("Found {}, skipping!".format(file))
+            continue
+        if charges is None:
+            charges = ChargeFields(model_path,n_phi,n_z,rotate_on_the_fly)
+
+        start_time = time.time()
+        indices = np.flatnonzero(matrix[:,k])
+        values = None
+        for idx in indices:
+            if values is None:
+                values = matrix[idx,k]*charges.values(idx)
+            else:
+                values += matrix[idx,k]*charges.values(idx)
+
+        Field(gridspec=(charges.grid,values,charges.components)).save(file)
+        print("Saved {} ({} charge fields) in {:.2f} seconds".format(file,len(indices),time.time() - start_time))
+
+    return files
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Build reduced basis fields for fitting with a symmetry scheme')
+    parser.add_argument('model_path',help='folder with charge_i/electric_field.txt')
+    parser.add_argument('--scheme',required=True,choices=sorted(schemes),help='symmetry scheme from xedrift.symmetry')
+    parser.add_argument('--n',type=int,default=1,help='number of sliding reflectors per symmetry unit')
+    parser.add_argument('--n-phi',type=int,default=48,help='number of phi charge sections (default: 48)')
+    parser.add_argument('--n-z',type=int,default=6,help='number of z charge sections (default: 6)')
+    parser.add_argument('--out',default=None,help='output folder (default: model_path/symmetry_<scheme>_<n>)')
+    parser.add_argument('--from-files',action='store_true',help='use the rotated files created by xedrift.fieldRotation.rotateFile')
+    parser.add_argument('--force',action='store_true',help='rebuild existing basis fields')
+    args = parser.parse_args(args)
+
+    out = args.out or os.path.join(args.model_path,'symmetry_{}_{}'.format(args.scheme,args.n))
+    build_symmetry_basis(args.model_path,out,args.scheme,args.n_phi,args.n_z,args.n,not args.from_files,args.force)
+
+if __name__ == '__main__':
+    main()